@@ -0,0 +1,67 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# _natlinktiming.py
+#   Control grammar for the timing of the grammar callbacks (see
+#   core/natlinktiming.py):
+#
+#   "natlink timing on" / "natlink timing off"
+#       Switch the timing on or off.
+#
+#   "natlink timing report"
+#       Print the report of the slowest handlers in the messages window and
+#       write it to reportFile.
+#
+#   "natlink timing reset"
+#       Remove the recorded data.
+#
+#   "natlink load report"
+#       Print the timing of loading the grammar modules.
+#
+import os, tempfile
+import natlinktiming
+from natlinkutils import GrammarBase
+
+reportFile = os.path.join(tempfile.gettempdir(), 'natlinktiming.txt')
+
+class ThisGrammar(GrammarBase):
+
+    gramSpec = """
+        <timing> exported = natlink timing (on | off | report | reset);
+        <loadReport> exported = natlink load report;
+    """
+
+    def initialize(self):
+        self.load(self.gramSpec)
+        self.activateAll()
+
+    def gotResults_timing(self, words, fullResults):
+        command = words[-1]
+        if command == 'on':
+            natlinktiming.enable()
+            print 'natlink timing is on'
+        elif command == 'off':
+            natlinktiming.disable()
+            print 'natlink timing is off'
+        elif command == 'reset':
+            natlinktiming.reset()
+            print 'natlink timing data removed'
+        else:
+            print natlinktiming.getReport(20)
+            try:
+                natlinktiming.writeReport(reportFile)
+                print '(complete report in file: %s)'% reportFile
+            except IOError, exc:
+                print 'natlink timing report not written: %s'% exc
+
+    def gotResults_loadReport(self, words, fullResults):
+        natlinktiming.printLoadReport()
+
+thisGrammar = ThisGrammar()
+thisGrammar.initialize()
+
+def unload():
+    global thisGrammar
+    if thisGrammar:
+        thisGrammar.unload()
+    thisGrammar = None
@@ -0,0 +1,208 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# gramcache.py
+#   This module keeps a persistent cache of compiled (packed) grammars, so
+#   GrammarBase.load can skip the scanner, the parser and packGrammar when a
+#   gramSpec is identical to one that was loaded before, in this session or
+#   in an earlier one.
+#
+# Each entry is stored in a separate file in the cache directory, the file
+# name being the key of the entry.  The key is a hash of the normalized
+# gramSpec (the lines after splitApartLines) together with the parser
+# version (gramparser.parserVersion) and the size of the packed integers.
+#
+# An entry is a dict with the keys:
+#   gramBin       the packed SAPI binary, as passed to GramObj.load
+#   exportRules   the exportRules dict of the GramParser object
+#   knownLists    the knownLists dict of the GramParser object
+#   knownRules    the knownRules dict of the GramParser object
+#
+# The cache is bounded by the number of entries and by the total size of the
+# entry files.  When one of these is exceeded, the least recently used
+# entries are removed.  The modification time of the entry files is used
+# for recording the last use, so this order survives a restart.
+#
+# Errors while reading or writing the cache are never fatal, the grammar is
+# then simply parsed and packed again.
+#
+import os, os.path, time
+import struct
+import cPickle as pickle
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import gramparser
+
+# extension of the entry files in the cache directory:
+cacheExtension = '.gramcache'
+
+class GrammarCache(object):
+    """persistent, size bounded cache of compiled grammars
+
+    directory: folder for the entry files, default the folder "grammarcache"
+               next to this module.  Created at the first store.
+    maxEntries: maximum number of entries kept (default 500)
+    maxBytes: maximum total size of the entries in bytes (default 20MB)
+
+    get(key) returns the entry dict or None,
+    put(key, entry) stores an entry,
+    getKey(gramSpec) computes the key of a (normalized) gramSpec.
+
+    The counters hits, misses, stores, evictions and errors can be
+    inspected with getStats().
+    """
+    def __init__(self, directory=None, maxEntries=500, maxBytes=20*1024*1024):
+        if directory is None:
+            directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'grammarcache')
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.index = None  # key: [size, lastUsed], filled at first use
+        self.totalBytes = 0
+        self.resetStats()
+
+    def resetStats(self):
+        """set the hit/miss counters to 0"""
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def getStats(self):
+        """return the counters and the current size of the cache in a dict
+        """
+        self.checkIndex()
+        return dict(hits=self.hits, misses=self.misses, stores=self.stores,
+                    evictions=self.evictions, errors=self.errors,
+                    entries=len(self.index), bytes=self.totalBytes)
+
+    def getKey(self, gramSpec, *extra):
+        """return the cache key of a gramSpec (a list of lines)
+
+        the gramSpec must already be normalized by gramparser.splitApartLines.
+        extra arguments (eg options that change the compiled result) are
+        included in the key.
+        """
+        if type(gramSpec) in (str, unicode):
+            gramSpec = [gramSpec]
+        h = sha1('%s;%s;%s\n'% (gramparser.parserVersion, struct.calcsize("L"),
+                                ';'.join([str(e) for e in extra])))
+        for line in gramSpec:
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            h.update(line)
+            h.update('\n')
+        return h.hexdigest()
+
+    def getFilePath(self, key):
+        return os.path.join(self.directory, key + cacheExtension)
+
+    def checkIndex(self):
+        """build the in memory index of the cache directory (once)
+        """
+        if self.index is not None:
+            return
+        self.index = {}
+        self.totalBytes = 0
+        try:
+            files = os.listdir(self.directory)
+        except OSError:
+            return
+        for f in files:
+            if not f.endswith(cacheExtension):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, f))
+            except OSError:
+                continue
+            self.index[f[:-len(cacheExtension)]] = [st.st_size, st.st_mtime]
+            self.totalBytes += st.st_size
+
+    def get(self, key):
+        """return the entry with this key, or None if not in the cache
+        """
+        self.checkIndex()
+        if key not in self.index:
+            self.misses += 1
+            return None
+        path = self.getFilePath(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # missing, truncated or otherwise invalid file:
+            self.errors += 1
+            self.misses += 1
+            self.removeEntry(key)
+            return None
+        self.hits += 1
+        now = time.time()
+        self.index[key][1] = now
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        """store an entry in the cache, and evict old entries if needed
+        """
+        self.checkIndex()
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        path = self.getFilePath(key)
+        tmpPath = '%s.%s.tmp'% (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            f = open(tmpPath, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if os.path.isfile(path):
+                os.remove(path)
+            os.rename(tmpPath, path)
+        except (IOError, OSError):
+            self.errors += 1
+            try: os.remove(tmpPath)
+            except OSError: pass
+            return
+        self.stores += 1
+        if key in self.index:
+            self.totalBytes -= self.index[key][0]
+        self.index[key] = [len(data), time.time()]
+        self.totalBytes += len(data)
+        self.evict()
+
+    def evict(self):
+        """remove least recently used entries until within the bounds
+        """
+        if len(self.index) <= self.maxEntries and self.totalBytes <= self.maxBytes:
+            return
+        byAge = sorted(self.index.items(), key=lambda item: item[1][1])
+        for key, (size, lastUsed) in byAge:
+            if len(self.index) <= self.maxEntries and self.totalBytes <= self.maxBytes:
+                break
+            self.removeEntry(key)
+            self.evictions += 1
+
+    def removeEntry(self, key):
+        if key in self.index:
+            self.totalBytes -= self.index[key][0]
+            del self.index[key]
+        try:
+            os.remove(self.getFilePath(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """remove all entries from the cache (the counters are kept)"""
+        self.checkIndex()
+        for key in self.index.keys():
+            self.removeEntry(key)
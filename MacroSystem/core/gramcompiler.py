@@ -0,0 +1,289 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# gramcompiler.py
+#   This module compiles all grammars of a directory (eg MacroSystem or a
+#   user directory) into SAPI grammar binaries, in parallel, for instance at
+#   deploy time.  Grammars are found in:
+#
+#   - standalone grammar files (extension .gram, see grammarExtensions),
+#     the grammar name is the file name without extension;
+#   - python grammar modules, from the constant gramSpec's at module level
+#     and in the classes (see gramparser.extractGramSpecsFromFile).  The
+#     modules are not imported.  The grammar name is "module" or
+#     "module.ClassName".
+#
+# For each grammar the output directory gets:
+#
+#   <name>.bin   the binary, as passed to GramObj.load
+#   <name>.sym   the symbol tables: a python dict (readable with
+#                ast.literal_eval) with the numbers of the rules, words and
+#                lists, and the exported and imported rules
+#
+# A grammar that cannot be compiled does not stop the run, its error info
+# is written in the output directory (see GrammarParserError.dumpToFile),
+# and is listed in the report.
+#
+# Command line:
+#
+#   python gramcompiler.py sourceDirectory outputDirectory [processes]
+#
+# compileDirectory(sourceDirectory, outputDirectory) does the same from
+# python, and returns the results (a list of dicts, see compileGrammar).
+#
+# GrammarPreparer does the same for the grammar cache (gramcache.py) while
+# natlinkmain imports the grammar modules at startup: the worker processes
+# compile the constant gramSpec's of the modules in the order of loading,
+# and before importing a module, natlinkmain waits (waitFor) until its
+# grammars are in the cache, so GrammarBase.load finds them there.  Only
+# the grammars that are not in the cache yet are compiled, and only for
+# load without optimize.  The cache is checked first, in natlinkmain: when
+# all grammars are there no worker processes are started.  A module that
+# is not done within waitTimeout seconds is not waited for any longer, its
+# grammars are then compiled by GrammarBase.load as before.
+#
+import sys, os, os.path, time, traceback, pprint
+import gramparser, gramcache
+
+# extensions of standalone grammar files:
+grammarExtensions = ('.gram',)
+
+def findGrammars(directory):
+    """return a list of (name, sourcePath, gramSpec) for the grammars in directory
+    """
+    result = []
+    for f in sorted(os.listdir(directory)):
+        path = os.path.join(directory, f)
+        if not os.path.isfile(path):
+            continue
+        base, ext = os.path.splitext(f)
+        if ext in grammarExtensions:
+            result.append((base, path, open(path, 'rU').readlines()))
+        elif ext == '.py':
+            for className, gramSpec in gramparser.extractGramSpecsFromFile(path):
+                name = className and '%s.%s'% (base, className) or base
+                result.append((name, path, gramSpec))
+    return result
+
+def compileGrammar(item):
+    """compile one grammar, item being (name, sourcePath, gramSpec, outputDirectory)
+
+    this is the function run in the worker processes.  Returns a dict with
+    name, source, ok, parseTime and packTime (in seconds), and binFile and
+    symFile, or error (the message) and errorFile.
+    """
+    name, sourcePath, gramSpec, outputDirectory = item
+    result = dict(name=name, source=sourcePath, ok=0, parseTime=0.0, packTime=0.0,
+                  binFile=None, symFile=None, error=None, errorFile=None)
+    try:
+        t0 = time.time()
+        gramSpec = list(gramSpec)
+        gramparser.splitApartLines(gramSpec)
+        parser = gramparser.GramParser(gramSpec, grammarName=name)
+        parser.doParse()
+        parser.checkForErrors()
+        t1 = time.time()
+        binary = gramparser.packGrammar(parser)
+        t2 = time.time()
+        result['parseTime'], result['packTime'] = t1 - t0, t2 - t1
+        result['binFile'] = os.path.join(outputDirectory, name + '.bin')
+        result['symFile'] = os.path.join(outputDirectory, name + '.sym')
+        f = open(result['binFile'], 'wb')
+        f.write(binary)
+        f.close()
+        f = open(result['symFile'], 'w')
+        f.write(pprint.pformat(getSymbolTables(parser)))
+        f.write('\n')
+        f.close()
+        result['ok'] = 1
+    except gramparser.GrammarParserError, exc:
+        result['error'] = exc.message
+        exc.dumpDirectory = outputDirectory  # also for str(exc)
+        result['errorFile'] = exc.dumpToFile()
+    except Exception, exc:
+        result['error'] = '%s: %s'% (exc.__class__.__name__, exc)
+        errorFile = os.path.join(outputDirectory, 'error_info_grammar_%s.txt'% name)
+        try:
+            open(errorFile, 'w').write(traceback.format_exc())
+            result['errorFile'] = '(more info in file: %s)'% errorFile
+        except IOError:
+            pass
+    return result
+
+def getSymbolTables(parseObj):
+    """the symbol tables of a parsed grammar, as written to the .sym files"""
+    return dict(rules=parseObj.knownRules, words=parseObj.knownWords,
+                lists=parseObj.knownLists,
+                exportRules=sorted(parseObj.exportRules.keys()),
+                importRules=sorted(parseObj.importRules.keys()))
+
+def compileDirectory(sourceDirectory, outputDirectory, processes=None):
+    """compile all grammars of sourceDirectory into outputDirectory
+
+    processes: number of worker processes (default: number of cpu's),
+    1 compiles in this process.  Returns the list of result dicts of
+    compileGrammar, in the order of the grammars.
+    """
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    items = [(name, path, gramSpec, outputDirectory)
+             for name, path, gramSpec in findGrammars(sourceDirectory)]
+    if processes != 1 and len(items) > 1:
+        pool = getPool(processes)
+        if pool:
+            try:
+                return pool.map(compileGrammar, items)
+            finally:
+                pool.close()
+                pool.join()
+    return map(compileGrammar, items)
+
+def getPool(processes=None):
+    """a multiprocessing.Pool, or None if not available
+
+    when python runs inside another program (natlink in Dragon), the worker
+    processes are started with the python executable of sys.exec_prefix.
+    """
+    try:
+        import multiprocessing
+        executable = os.path.basename(sys.executable).lower()
+        if not executable.startswith('python'):
+            for name in ('pythonw.exe', 'python.exe'):
+                path = os.path.join(sys.exec_prefix, name)
+                if os.path.isfile(path):
+                    multiprocessing.set_executable(path)
+                    break
+            else:
+                return None
+        return multiprocessing.Pool(processes)
+    except (ImportError, OSError, NotImplementedError, ValueError):
+        return None
+
+def getMissingGramSpecs(path, cache):
+    """return a list of (key, gramSpec) of the constant gramSpec's of the
+    module file path that are not in the grammar cache
+    """
+    missing = []
+    for className, gramSpec in gramparser.extractGramSpecsFromFile(path):
+        gramparser.splitApartLines(gramSpec)
+        key = cache.getKey(gramSpec, 0)
+        if not os.path.isfile(cache.getFilePath(key)):
+            missing.append( (key, gramSpec) )
+    return missing
+
+def prepareModule(item):
+    """compile the gramSpec's of one module for the grammar cache
+
+    item is (modName, path, cacheDirectory), this is the function run in the
+    worker processes of GrammarPreparer.  Returns (modName, entries),
+    entries being a list of (key, compiled) for the grammars that are not in
+    the cache yet, compiled as in GrammarBase.load.
+    """
+    modName, path, cacheDirectory = item
+    cache = gramcache.GrammarCache(cacheDirectory)
+    entries = []
+    for key, gramSpec in getMissingGramSpecs(path, cache):
+        try:
+            parser = gramparser.GramParser(gramSpec)
+            parser.doParse()
+            parser.checkForErrors()
+            compiled = dict(gramBin=gramparser.packGrammar(parser),
+                            exportRules=parser.exportRules,
+                            knownLists=parser.knownLists,
+                            knownRules=parser.knownRules,
+                            ruleAliases=parser.ruleAliases)
+        except Exception:
+            # the error is reported when the module loads the grammar
+            continue
+        entries.append( (key, compiled) )
+    return modName, entries
+
+class GrammarPreparer(object):
+    """compiles the grammars of modules into the grammar cache in the background
+
+    modules: list of (modName, path) in the order they are imported, only
+        the modules with grammars that are not in the cache (see
+        getMissingGramSpecs)
+    cache: a gramcache.GrammarCache
+    processes: number of worker processes (default: number of cpu's)
+
+    waitFor(modName) returns when the grammars of modName are in the cache,
+    or after waitTimeout seconds (a worker process that died never returns
+    its module), close() stops the workers.  If no worker processes can be
+    started, nothing is prepared (the grammars are compiled by load as
+    before).
+    """
+    waitTimeout = 10
+
+    def __init__(self, modules, cache, processes=None):
+        self.cache = cache
+        self.pending = set([modName for modName, path in modules])
+        self.prepared = self.timeouts = 0
+        self.startTime = time.time()
+        self.pool = modules and getPool(processes)
+        if self.pool:
+            items = [(modName, path, cache.directory) for modName, path in modules]
+            self.results = self.pool.imap_unordered(prepareModule, items)
+        else:
+            self.pending = set()
+
+    def waitFor(self, modName):
+        if modName not in self.pending:
+            return
+        from multiprocessing import TimeoutError
+        while modName in self.pending:
+            try:
+                doneName, entries = self.results.next(self.waitTimeout)
+            except TimeoutError:
+                # load compiles the grammars of this module itself
+                self.timeouts += 1
+                self.pending.discard(modName)
+                break
+            except Exception:
+                # a broken pool (or no results left): load compiles the
+                # grammars itself
+                self.pending = set()
+                break
+            self.pending.discard(doneName)
+            for key, compiled in entries:
+                self.cache.put(key, compiled)
+                self.prepared += 1
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending = set()
+
+    def getStats(self):
+        return dict(prepared=self.prepared, pending=len(self.pending),
+                    timeouts=self.timeouts, seconds=time.time() - self.startTime)
+
+def formatResults(results):
+    """the report of compileDirectory, one line per grammar plus a summary"""
+    L = []
+    nErrors = 0
+    for r in results:
+        if r['ok']:
+            L.append('%-40s parse %7.1f ms  pack %6.1f ms'% \
+                     (r['name'], r['parseTime']*1000, r['packTime']*1000))
+        else:
+            nErrors += 1
+            L.append('%-40s ERROR %s %s'% (r['name'], r['error'], r['errorFile'] or ''))
+    totalParse = sum([r['parseTime'] for r in results])
+    totalPack = sum([r['packTime'] for r in results])
+    L.append('%s grammars compiled, %s errors, parse %.1f ms, pack %.1f ms'% \
+             (len(results) - nErrors, nErrors, totalParse*1000, totalPack*1000))
+    return '\n'.join(L)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) not in (2, 3):
+        print 'usage: python gramcompiler.py sourceDirectory outputDirectory [processes]'
+        sys.exit(2)
+    processes = len(args) == 3 and int(args[2]) or None
+    results = compileDirectory(args[0], args[1], processes)
+    print formatResults(results)
+    if [r for r in results if not r['ok']]:
+        sys.exit(1)
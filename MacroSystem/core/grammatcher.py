@@ -0,0 +1,382 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# grammatcher.py
+#   This module matches word sequences against a command grammar without a
+#   recognizer, so grammar callbacks can be tested and timed offline (also on
+#   Linux).  It gives the wordsAndNums list that Dragon passes to
+#   GrammarBase.resultsCallback: a list of (word, ruleNumber) tuples, the
+#   rule number being the number of the innermost rule that produced the
+#   word.
+#
+# Usage:
+#
+#   matcher = GrammarMatcher(parseObj)   # GramParser object after doParse
+#   matcher.setList('colors', ['red', 'light blue'])
+#   matcher.match(['paint', 'light blue'])
+#   --> [('paint', 1), ('light blue', 1)], or None if there is no match
+#
+#   grammar.resultsCallback(wordsAndNums, None) then makes the usual
+#   gotResultsInit, gotResults_xxx and gotResults callbacks of a
+#   GrammarBase instance grammar (which must be loaded with the same
+#   gramSpec, so the rule numbers are the same).
+#
+# The grammar is compiled into a nondeterministic automaton (NFA) over
+# words, referenced rules being expanded in place.  Sequences, alternatives,
+# optionals, repeats and lists are supported.  A word or list entry of more
+# than one word ("light blue") matches these words in the input, either as
+# separate words or as one word, and is reported as one word, like Dragon
+# does.  The imported rules dgndictation and dgnletters match one or more
+# arbitrary words, dgnwords matches one arbitrary word; other imported rules
+# (from other grammars) never match.  When the words can be parsed in more
+# than one way, words of the grammar are preferred over dictation.
+#
+# Matching runs through a lazily built deterministic automaton (DFA): each
+# set of NFA states met is given a number, and its transition for a word is
+# computed once and then kept in a dict.  The path through the NFA, needed
+# for the rule numbers, is found backwards from the accepting state.  The
+# DFA is cleared when the lists or the active rules change, and when it
+# grows over maxTransitions (dictation words add transitions).
+#
+import time
+import gramparser
+from gramparser import AltCode, RepCode, OptCode, ruleDefinitionToTree
+
+# label of a node that matches any word:
+WILDCARD = object()
+
+# imported rules matching one or more words, resp. exactly one word:
+dictationRules = ('dgndictation', 'dgnletters')
+singleWordRules = ('dgnwords',)
+
+class GrammarMatcher(object):
+    """matches word sequences against the exported rules of a grammar
+
+    parseObj: a GramParser object after doParse (and checkForErrors)
+    activeRules: the exported rules to match, default all of them
+
+    setList, appendList and emptyList set the contents of the lists,
+    activate/deactivate/activateSet the rules to match, match(words)
+    returns the wordsAndNums list or None.
+    """
+    maxTransitions = 100000
+
+    def __init__(self, parseObj, activeRules=None):
+        self.parseObj = parseObj
+        self.ruleNames = dict([(v,k) for k,v in parseObj.knownRules.items()])
+        self.wordNames = dict([(v,k) for k,v in parseObj.knownWords.items()])
+        self.listNames = dict([(v,k) for k,v in parseObj.knownLists.items()])
+        self.lists = dict([(name, []) for name in parseObj.knownLists.keys()])
+        if activeRules is None:
+            activeRules = parseObj.exportRules.keys()
+        self.activeRules = list(activeRules)
+        self.trees = {}
+        self.compiled = 0
+
+    # lists and rules, like in GrammarBase:
+
+    def setList(self, listName, words):
+        self.emptyList(listName)
+        self.appendList(listName, words)
+
+    def emptyList(self, listName):
+        if listName not in self.lists:
+            mess = "list %s was not defined in the grammar"% listName
+            raise gramparser.GrammarError(mess, self.parseObj.scanObj)
+        self.lists[listName] = []
+        self.compiled = 0
+
+    def appendList(self, listName, words):
+        if listName not in self.lists:
+            mess = "list %s was not defined in the grammar"% listName
+            raise gramparser.GrammarError(mess, self.parseObj.scanObj)
+        if type(words) in (str, unicode):
+            words = [words]
+        self.lists[listName].extend(words)
+        self.compiled = 0
+
+    def activate(self, ruleName):
+        if ruleName not in self.parseObj.exportRules:
+            mess = "rule %s was not exported in the grammar"% ruleName
+            raise gramparser.GrammarError(mess, self.parseObj.scanObj)
+        if ruleName not in self.activeRules:
+            self.activeRules.append(ruleName)
+            self.compiled = 0
+
+    def deactivate(self, ruleName):
+        if ruleName in self.activeRules:
+            self.activeRules.remove(ruleName)
+            self.compiled = 0
+
+    def activateSet(self, ruleNames):
+        for ruleName in ruleNames:
+            if ruleName not in self.parseObj.exportRules:
+                mess = "rule %s was not exported in the grammar"% ruleName
+                raise gramparser.GrammarError(mess, self.parseObj.scanObj)
+        self.activeRules = list(ruleNames)
+        self.compiled = 0
+
+    # building the NFA.  Each node has a list of epsilon transitions (eps),
+    # and a node with a label consumes one word (equal to the label, or any
+    # word for WILDCARD) and goes to its target node.  For these nodes also
+    # the rule number and the word to report (output) are kept, output is
+    # None for the first words of a multi word entry.
+
+    def newNode(self, label=None, ruleNumber=None, output=None):
+        self.eps.append([])
+        self.label.append(label)
+        self.target.append(None)
+        self.ruleNumber.append(ruleNumber)
+        self.output.append(output)
+        return len(self.eps) - 1
+
+    def compile(self):
+        self.eps, self.label, self.target = [], [], []
+        self.ruleNumber, self.output = [], []
+        self.start = self.newNode()
+        self.accept = self.newNode()
+        for ruleName in self.activeRules:
+            if ruleName not in self.parseObj.ruleDefines:
+                continue
+            entry = self.newNode()
+            self.eps[self.start].append(entry)
+            tree = self.getTree(ruleName)
+            ruleNumber = self.parseObj.knownRules[ruleName]
+            exit = self.buildNode(tree, entry, ruleNumber, [ruleName])
+            if exit is not None:
+                self.eps[exit].append(self.accept)
+        self.closures = {}
+        self.clearDFA()
+        self.compiled = 1
+
+    def getTree(self, ruleName):
+        if ruleName not in self.trees:
+            self.trees[ruleName] = ruleDefinitionToTree(
+                self.parseObj.ruleDefines[ruleName])
+        return self.trees[ruleName]
+
+    def buildWords(self, text, entry, ruleNumber):
+        """chain of nodes for a (multi word) entry, returns the exit node"""
+        tokens = text.split()
+        if not tokens:
+            return None
+        node = entry
+        for i, token in enumerate(tokens):
+            output = (i == len(tokens)-1) and text or None
+            t = self.newNode(token, ruleNumber, output)
+            self.eps[node].append(t)
+            node = self.newNode()
+            self.target[t] = node
+        return node
+
+    def buildNode(self, node, entry, ruleNumber, stack):
+        """build the NFA for a rule tree node starting at entry
+
+        returns the exit node, or None if nothing can be matched
+        """
+        kind = node[0]
+        if kind == 'word':
+            return self.buildWords(self.wordNames[node[1]], entry, ruleNumber)
+        if kind == 'list':
+            exit = self.newNode()
+            for text in self.lists[self.listNames[node[1]]]:
+                end = self.buildWords(text, entry, ruleNumber)
+                if end is not None:
+                    self.eps[end].append(exit)
+            return exit
+        if kind == 'rule':
+            ruleName = self.ruleNames[node[1]]
+            if ruleName in self.parseObj.ruleDefines:
+                if ruleName in stack:
+                    return None
+                return self.buildNode(self.getTree(ruleName), entry, node[1],
+                                      stack + [ruleName])
+            if ruleName in dictationRules or ruleName in singleWordRules:
+                t = self.newNode(WILDCARD, node[1])
+                self.eps[entry].append(t)
+                exit = self.newNode()
+                self.target[t] = exit
+                if ruleName in dictationRules:
+                    self.eps[exit].append(t)
+                return exit
+            return None
+        children = node[1]
+        if kind == AltCode:
+            exit = self.newNode()
+            for child in children:
+                branch = self.newNode()
+                self.eps[entry].append(branch)
+                end = self.buildNode(child, branch, ruleNumber, stack)
+                if end is not None:
+                    self.eps[end].append(exit)
+            return exit
+        # sequence, and the contents of optional and repeat:
+        start = self.newNode()
+        self.eps[entry].append(start)
+        end = start
+        for child in children:
+            end = self.buildNode(child, end, ruleNumber, stack)
+            if end is None:
+                break
+        exit = self.newNode()
+        if end is not None:
+            self.eps[end].append(exit)
+            if kind == RepCode:
+                self.eps[end].append(start)
+        if kind == OptCode:
+            self.eps[entry].append(exit)
+        elif end is None:
+            return None
+        return exit
+
+    def closure(self, node):
+        """the set of nodes reachable from node by epsilon transitions"""
+        try:
+            return self.closures[node]
+        except KeyError:
+            pass
+        result = set([node])
+        todo = [node]
+        eps = self.eps
+        while todo:
+            n = todo.pop()
+            for m in eps[n]:
+                if m not in result:
+                    result.add(m)
+                    todo.append(m)
+        result = frozenset(result)
+        self.closures[node] = result
+        return result
+
+    # the lazy DFA.  A DFA state is a tuple of the nodes with a label in a
+    # closure, a state number indexes dfaNodes, dfaAccept and dfaNext.
+
+    def clearDFA(self):
+        self.dfaNodes = []
+        self.dfaAccept = []
+        self.dfaNext = []
+        self.dfaIndex = {}
+        self.nTransitions = 0
+        self.dfaStart = self.getDFAState(self.closure(self.start))
+
+    def getDFAState(self, nodes):
+        label = self.label
+        key = tuple(sorted([n for n in nodes if label[n] is not None]))
+        accepting = self.accept in nodes
+        try:
+            return self.dfaIndex[key, accepting]
+        except KeyError:
+            pass
+        state = len(self.dfaNodes)
+        self.dfaNodes.append(key)
+        self.dfaAccept.append(accepting)
+        self.dfaNext.append({})
+        self.dfaIndex[key, accepting] = state
+        return state
+
+    def getNextState(self, state, word):
+        """compute the transition of a DFA state on word (-1: no match)"""
+        label, target = self.label, self.target
+        nodes = set()
+        for n in self.dfaNodes[state]:
+            if label[n] == word or label[n] is WILDCARD:
+                nodes |= self.closure(target[n])
+        if nodes:
+            nextState = self.getDFAState(nodes)
+        else:
+            nextState = -1
+        self.dfaNext[state][word] = nextState
+        self.nTransitions += 1
+        return nextState
+
+    # matching:
+
+    def splitWords(self, words):
+        tokens = []
+        for w in words:
+            if ' ' in w:
+                tokens.extend(w.split())
+            else:
+                tokens.append(w)
+        return tokens
+
+    def match(self, words):
+        """return the wordsAndNums list for words, or None if no match
+
+        words is a list of words (an entry of more than one word may be given
+        as one word) or a string of words separated by spaces.
+        """
+        if not self.compiled:
+            self.compile()
+        elif self.nTransitions >= self.maxTransitions:
+            self.clearDFA()
+        if type(words) in (str, unicode):
+            words = words.split()
+        tokens = self.splitWords(words)
+        states = [self.dfaStart]
+        state = self.dfaStart
+        for token in tokens:
+            try:
+                state = self.dfaNext[state][token]
+            except KeyError:
+                state = self.getNextState(state, token)
+            if state < 0:
+                return None
+            states.append(state)
+        if not self.dfaAccept[state] or not tokens:
+            return None
+        return self.getPath(tokens, states)
+
+    def getPath(self, tokens, states):
+        """find the nodes that consumed the tokens, backwards"""
+        label, target, dfaNodes = self.label, self.target, self.dfaNodes
+        need = self.accept
+        path = []
+        for i in range(len(tokens)-1, -1, -1):
+            token = tokens[i]
+            chosen = None
+            for n in dfaNodes[states[i]]:
+                if label[n] == token and need in self.closure(target[n]):
+                    chosen = n
+                    break
+                if label[n] is WILDCARD and chosen is None and \
+                        need in self.closure(target[n]):
+                    chosen = n
+            path.append(chosen)
+            need = chosen
+        path.reverse()
+        result = []
+        for token, n in zip(tokens, path):
+            if label[n] is WILDCARD:
+                result.append((token, self.ruleNumber[n]))
+            elif self.output[n] is not None:
+                result.append((self.output[n], self.ruleNumber[n]))
+        return result
+
+    def matchMany(self, utterances):
+        """match a list of utterances, returns a list of wordsAndNums (or None)
+        """
+        return map(self.match, utterances)
+
+def makeMatcher(gramSpec, grammarName=None, activeRules=None):
+    """parse a gramSpec (string or list of strings) and return a GrammarMatcher
+    """
+    if type(gramSpec) in (str, unicode):
+        gramSpec = [gramSpec]
+    gramSpec = list(gramSpec)
+    gramparser.splitApartLines(gramSpec)
+    parser = gramparser.GramParser(gramSpec, grammarName=grammarName)
+    parser.doParse()
+    parser.checkForErrors()
+    return GrammarMatcher(parser, activeRules)
+
+def benchmarkMatcher(matcher, utterances, count=3):
+    """return the number of utterances matched per second (best of count)"""
+    best = None
+    for i in range(count):
+        t0 = time.clock()
+        matcher.matchMany(utterances)
+        elapsed = time.clock() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(utterances)/max(best, 1e-6)
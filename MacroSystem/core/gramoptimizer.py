@@ -0,0 +1,244 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# gramoptimizer.py
+#   An optional optimization pass over a parsed grammar (a GramParser
+#   object), to be done between doParse/checkForErrors and packGrammar.  It
+#   makes the grammar binary smaller, so Dragon has less to compile and to
+#   search, without changing what can be recognised or the rule names
+#   reported in the recognition results.
+#
+# The following steps are done (each can be switched off):
+#
+#   prune:   rules which cannot be reached from the exported rules are
+#            removed (also unused imported rules), and words which are not
+#            used any more.  Lists are kept, so setList keeps working for all
+#            lists of the grammar.
+#   flatten: a sequence or alternative with only one element is replaced by
+#            that element, a sequence inside a sequence and an alternative
+#            inside an alternative are merged, a repeat of a repeat and an
+#            optional of an optional are reduced to one, and identical
+#            alternatives are removed.
+#   share:   a sub-expression which occurs more than once inside a rule is
+#            moved into a new internal rule, which is referenced at each
+#            occurrence.  Dragon reports the words of this internal rule with
+#            its own rule number, so these rules are kept in
+#            parseObj.ruleAliases ({internalRuleName: originalRuleName}), and
+#            GrammarBase.load maps them back to the original rule.  Because
+#            of this, sub-expressions are not shared between different rules.
+#
+# Usage:
+#
+#   parser.doParse()
+#   parser.checkForErrors()
+#   report = gramoptimizer.optimizeGrammar(parser)
+#   print gramoptimizer.formatReport(report)
+#   gramBin = gramparser.packGrammar(parser)
+#
+# GrammarBase.load does this when called with optimize=1 (or when the class
+# attribute optimizeGrammar is set).
+#
+from gramparser import SeqCode, AltCode, ruleDefinitionToTree, ruleTreeToDefinition
+
+def optimizeGrammar(parseObj, prune=1, flatten=1, share=1, minShareSize=4):
+    """optimize the rule definitions of a parsed grammar (in place)
+
+    minShareSize: the minimum number of elements of a sub-expression to be
+                  moved into an internal rule.
+
+    returns a report dict, with the number of elements, words and rules
+    before and after, and the names of the removed and the internal rules.
+    """
+    report = {}
+    report['elementsBefore'] = countElements(parseObj)
+    report['wordsBefore'] = len(parseObj.knownWords)
+    report['rulesBefore'] = len(parseObj.ruleDefines)
+    report['removedRules'] = []
+    report['sharedRules'] = []
+    if not hasattr(parseObj, 'ruleAliases'):
+        parseObj.ruleAliases = {}
+
+    if prune:
+        report['removedRules'] = pruneRules(parseObj)
+    if flatten or share:
+        for ruleName in parseObj.ruleDefines.keys():
+            tree = ruleDefinitionToTree(parseObj.ruleDefines[ruleName])
+            if flatten:
+                tree = flattenTree(tree)
+            if share:
+                tree, shared = shareSubExpressions(parseObj, ruleName, tree, minShareSize)
+                report['sharedRules'].extend(shared)
+            parseObj.ruleDefines[ruleName] = ruleTreeToDefinition(tree)
+    if prune:
+        pruneWords(parseObj)
+
+    report['elementsAfter'] = countElements(parseObj)
+    report['wordsAfter'] = len(parseObj.knownWords)
+    report['rulesAfter'] = len(parseObj.ruleDefines)
+    return report
+
+def formatReport(report):
+    """return the optimize report as a (one line) string"""
+    return 'elements: %s -> %s, words: %s -> %s, rules: %s -> %s (removed: %s, shared: %s)'% \
+           (report['elementsBefore'], report['elementsAfter'],
+            report['wordsBefore'], report['wordsAfter'],
+            report['rulesBefore'], report['rulesAfter'],
+            len(report['removedRules']), len(report['sharedRules']))
+
+def countElements(parseObj):
+    """total number of elements in the rule definitions"""
+    total = 0
+    for definition in parseObj.ruleDefines.values():
+        total += len(definition)
+    return total
+
+#
+# prune
+#
+
+def findReachableRules(parseObj):
+    """return the set of rule names which can be reached from the exported rules
+    """
+    ruleNames = dict([(v,k) for k,v in parseObj.knownRules.items()])
+    reachable = set()
+    todo = parseObj.exportRules.keys()
+    while todo:
+        ruleName = todo.pop()
+        if ruleName in reachable:
+            continue
+        reachable.add(ruleName)
+        for kind, value in parseObj.ruleDefines.get(ruleName, []):
+            if kind == 'rule' and ruleNames[value] not in reachable:
+                todo.append(ruleNames[value])
+    return reachable
+
+def pruneRules(parseObj):
+    """remove the rules that cannot be reached, returns their names"""
+    reachable = findReachableRules(parseObj)
+    removed = []
+    for ruleName in parseObj.knownRules.keys():
+        if ruleName in reachable:
+            continue
+        if ruleName in parseObj.ruleDefines:
+            del parseObj.ruleDefines[ruleName]
+        if ruleName in parseObj.importRules:
+            del parseObj.importRules[ruleName]
+        del parseObj.knownRules[ruleName]
+        removed.append(ruleName)
+    return removed
+
+def pruneWords(parseObj):
+    """remove the words which are not used in any rule definition"""
+    used = set()
+    for definition in parseObj.ruleDefines.values():
+        for kind, value in definition:
+            if kind == 'word':
+                used.add(value)
+    for word, number in parseObj.knownWords.items():
+        if number not in used:
+            del parseObj.knownWords[word]
+
+#
+# flatten
+#
+
+def isGroup(node):
+    return type(node[0]) == int
+
+def flattenTree(node):
+    """return the flattened version of a (sub)tree"""
+    if not isGroup(node):
+        return node
+    code = node[0]
+    children = [flattenTree(child) for child in node[1]]
+    if code in (SeqCode, AltCode):
+        merged = []
+        for child in children:
+            if isGroup(child) and child[0] == code:
+                merged.extend(child[1])
+            else:
+                merged.append(child)
+        if code == AltCode:
+            seen = set()
+            unique = []
+            for child in merged:
+                if child not in seen:
+                    seen.add(child)
+                    unique.append(child)
+            merged = unique
+        if len(merged) == 1:
+            return merged[0]
+        return (code, tuple(merged))
+    # repeat or optional:
+    if len(children) == 1 and isGroup(children[0]) and children[0][0] == code:
+        return children[0]
+    return (code, tuple(children))
+
+#
+# share
+#
+
+def treeSize(node, sizes):
+    """number of elements of a (sub)tree, sizes is a memo dict"""
+    if not isGroup(node):
+        return 1
+    try:
+        return sizes[node]
+    except KeyError:
+        size = 2
+        for child in node[1]:
+            size += treeSize(child, sizes)
+        sizes[node] = size
+        return size
+
+def countSubTrees(node, counts):
+    """count the groups below node (node itself not included)"""
+    for child in node[1]:
+        if isGroup(child):
+            counts[child] = counts.get(child, 0) + 1
+            countSubTrees(child, counts)
+
+def replaceSubTree(node, old, new):
+    if node == old:
+        return new
+    if not isGroup(node):
+        return node
+    return (node[0], tuple([replaceSubTree(child, old, new) for child in node[1]]))
+
+def shareSubExpressions(parseObj, ruleName, tree, minShareSize):
+    """move repeated sub-expressions of a rule into internal rules
+
+    returns the new tree and the list of names of the new rules.
+    """
+    shared = []
+    sizes = {}
+    while isGroup(tree):
+        counts = {}
+        countSubTrees(tree, counts)
+        best, bestSaving = None, 0
+        for node, count in counts.items():
+            if count < 2:
+                continue
+            size = treeSize(node, sizes)
+            if size < minShareSize:
+                continue
+            # each occurrence becomes one element, the rule definition
+            # costs the elements plus its header (2 DWORD's):
+            saving = count*size - count - size - 1
+            if saving > bestSaving:
+                best, bestSaving = node, saving
+        if best is None:
+            break
+        i = len(shared) + 1
+        newName = '%s_shared%s'% (ruleName, i)
+        while newName in parseObj.knownRules:
+            i += 1
+            newName = '%s_shared%s'% (ruleName, i)
+        newNumber = parseObj.nextRule
+        parseObj.nextRule += 1
+        parseObj.knownRules[newName] = newNumber
+        parseObj.ruleDefines[newName] = ruleTreeToDefinition(best)
+        parseObj.ruleAliases[newName] = parseObj.ruleAliases.get(ruleName, ruleName)
+        tree = replaceSubTree(tree, best, ('rule', newNumber))
+        shared.append(newName)
+    return tree, shared
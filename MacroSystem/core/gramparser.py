@@ -51,6 +51,7 @@
 ########################################################################
 
 from struct import pack
+import struct
 import re, sys, os, os.path, traceback
 reAlphaNumeric = re.compile('\w+$')
 #
@@ -63,11 +64,17 @@ reAlphaNumeric = re.compile('\w+$')
 #
 
 import string, pprint, copy
+import ast
 
 class GrammarParserError(Exception):
     """these exceptions all expect the scanObj as second parameter
     in order to produce the correct message info
+
+    the error info file is written in dumpDirectory, default (None) the
+    folder of this module.
     """
+    dumpDirectory = None
+
     def __init__(self, message, scanObj):
         self.message = message
         self.scanObj = scanObj
@@ -104,11 +111,13 @@ class GrammarParserError(Exception):
             
         return '\n'.join(L)
         
-    def dumpToFile(self):
+    def dumpToFile(self, directory=None):
         """dump grammar and traceback to a file for debugging purposes
+
+        directory: the folder of the file, default dumpDirectory
         """
         gramName = self.scanObj.grammarName
-        dirName = os.path.dirname(__file__)
+        dirName = directory or self.dumpDirectory or os.path.dirname(__file__)
         if gramName:
             filename = 'error_info_grammar_%s.txt'% gramName
         else:
@@ -159,6 +168,11 @@ AltCode = 2     # alternative
 RepCode = 3     # repeat
 OptCode = 4     # optional
 
+# version of the parser and packer output, part of the key of the compiled
+# grammar cache (gramcache.py).  Increment when ruleDefines or the packed
+# binary of a grammar can change, so old cache entries are not used any more.
+parserVersion = 1
+
 class GramScanner(object):
 
     def __init__(self,text=None, grammarName=None):
@@ -306,6 +320,140 @@ class GramScanner(object):
 
         self.char = ch
 
+#
+# This is a second lexical scanner, with the same interface, the same token
+# stream and the same error positions as GramScanner.  Instead of walking
+# through the text one character at a time, the complete text is tokenized at
+# the first call of getAnotherToken, with one compiled regular expression
+# over the joined lines.  The following calls of getAnotherToken only step
+# through the list of tokens.
+#
+# Lexical errors are kept in the token list, and are raised when the parser
+# reaches them, so the parser sees exactly the same sequence of tokens and
+# errors as with GramScanner.
+#
+
+class GramScannerRegex(GramScanner):
+
+    # compiled patterns, keyed by the value of string.letters (which can
+    # change with the locale, see isCharOrDigit):
+    tokenPatterns = {}
+
+    def __init__(self,text=None, grammarName=None):
+        GramScanner.__init__(self, text, grammarName=grammarName)
+        # normalize the lines the same way skipWhiteSpace does:
+        for i in range(1, len(self.text)):
+            self.text[i] = self.text[i].replace('\t', ' ').replace('\n', ' ')
+        self.tokens = None
+        self.tokenIndex = 0
+
+    def newText(self,text):
+        GramScannerRegex.__init__(self, text, self.grammarName)
+
+    def getTokenPattern(self):
+        letters = string.letters
+        try:
+            return self.tokenPatterns[letters]
+        except KeyError:
+            pass
+        # a word is a sequence of isCharOrDigit characters:
+        wordChars = re.escape(letters + string.digits)
+        pat = re.compile(r"""
+            ((?:[%s]+|\#[^\n]*)*)                # 1: whitespace and comments
+            (?:([()\[\]|+=;\0])                 # 2: single character token
+              |"([^"\n]*)"                      # 3: dqword
+              |'([^'\n]*)'                      # 4: sqword
+              |<([^>\n]*)>                      # 5: rule
+              |\{([^}\n]*)\}                    # 6: list
+              |((?:[%s]|[^\x00-\xbf])+)         # 7: word
+            )?""" % (re.escape(string.whitespace), wordChars), re.VERBOSE)
+        self.tokenPatterns[letters] = pat
+        return pat
+
+    def tokenize(self):
+        """make the list of tokens of the complete text
+
+        each item is (token, value, line, start, char, whitespace, isError),
+        for a lexical error the message is in value.
+
+        If the first line contains a newline (not split by splitApartLines),
+        the token list is not made, the characters are then scanned by
+        GramScanner.getAnotherToken.
+        """
+        text = self.text
+        if '\n' in text[0]:
+            self.tokens = []
+            return
+        buf = '\n'.join(text)
+        lineStarts = []
+        pos = 0
+        for ln in text:
+            lineStarts.append(pos)
+            pos += len(ln) + 1
+        lineStarts.append(pos)
+        match = self.getTokenPattern().match
+        tokens = []
+        append = tokens.append
+        line, lineStart, nextLineStart = 0, 0, lineStarts[1]
+        pos = 0
+        while 1:
+            m = match(buf, pos)
+            start = m.end(1)
+            while start >= nextLineStart:
+                line += 1
+                lineStart, nextLineStart = nextLineStart, lineStarts[line+1]
+            pos = end = m.end()
+            group = m.lastindex
+            if group == 1 or group is None:
+                # as in GramScanner, the token is set, except for an unknown
+                # character:
+                token, message = self.errorTokens.get(buf[start:start+1],
+                                                      (None, "unknown character found"))
+                col = start - lineStart
+                append( (token, message, line, col, col, m.group(1), 1) )
+                break
+            if group == 2:
+                token, value = m.group(2), None
+            else:
+                token, value = self.groupTokens[group], m.group(group)
+            append( (token, value, line, start-lineStart, end-lineStart, m.group(1), 0) )
+            if token == '\0':
+                break
+        self.tokens = tokens
+        self.tokenIndex = 0
+
+    groupTokens = {3:'dqword', 4:'sqword', 5:'rule', 6:'list', 7:'word'}
+    errorTokens = {'"': ('dqword', "expecting closing quote in word name"),
+                   "'": ('sqword', "expecting closing quote in word name"),
+                   '<': ('rule', "expecting closing angle bracket in rule name"),
+                   '{': ('list', "expecting closing brace in list name")}
+
+    def skipWhiteSpace(self):
+        """whitespace is skipped in tokenize (if there is a token list)"""
+        if not self.tokens:
+            GramScanner.skipWhiteSpace(self)
+
+    def getAnotherToken(self):
+        """return a token and (if appropriate) the corresponding value
+
+        see GramScanner.getAnotherToken
+        """
+        if self.token == '\0':
+            return None
+        if self.tokens is None:
+            self.tokenize()
+        if not self.tokens:
+            return GramScanner.getAnotherToken(self)
+        token, value, self.line, self.start, self.char, self.lastWhiteSpace, isError = \
+                   self.tokens[self.tokenIndex]
+        self.tokenIndex += 1
+        if isError:
+            self.value = None
+            if token:
+                self.token = token
+            raise LexicalError(value, self)
+        self.token, self.value = token, value
+
 ## generator function, scanning the tokens and whitespace of a gramspec:
 ## this class can scan a grammar, return the tokens in a generator function
 ## and put back the results exactly the same:
@@ -412,8 +560,16 @@ class peek_ahead(object):
 
 class GramParser(object):
 
-    def __init__(self,text=[''], grammarName=None):
-        self.scanObj = GramScanner(text, grammarName=grammarName)
+    # the scanner to use, can be changed per instance with scannerClass.
+    # GramScanner stays the default: with GramScannerRegex the parse is only
+    # 7-12% faster (see benchmarkParser), most time is spent per token in
+    # the parser itself:
+    scannerClass = GramScanner
+
+    def __init__(self,text=[''], grammarName=None, scannerClass=None):
+        if scannerClass:
+            self.scannerClass = scannerClass
+        self.scanObj = self.scannerClass(text, grammarName=grammarName)
         self.knownRules = {}
         self.knownWords = {}
         self.knownLists = {}
@@ -423,6 +579,8 @@ class GramParser(object):
         self.exportRules = {}
         self.importRules = {}
         self.ruleDefines = {}
+        # internal rules made by gramoptimizer, {ruleName: originalRuleName}:
+        self.ruleAliases = {}
         self.grammarName = grammarName or ""
 
     def doParse(self,*text):
@@ -469,42 +627,52 @@ class GramParser(object):
             self.ruleDefines[ruleName] = self.parseExpr()
         self.scanObj.testAndEatToken(';')
 
-    def parseExpr(self):
-        definition = []
+    # The parseExpr functions append the elements of a rule definition to one
+    # list (definition), which is created in parseExpr at the start of the
+    # rule.  The start element of a group (alternative, sequence, repeat) is
+    # only known after the group is parsed, it is then inserted at the
+    # position where the group started.  This costs the size of the group
+    # only, so parsing is linear in the number of alternatives (times the
+    # nesting depth), where concatenating lists at each level was quadratic.
+
+    def parseExpr(self, definition=None):
+        if definition is None:
+            definition = []
+            self.parseExpr(definition)
+            return definition
+        mark = len(definition)
         moreThanOne = 0
         while 1:
-            definition = definition + self.parseExpr2()
+            self.parseExpr2(definition)
             if self.scanObj.token != '|':
                 break
             self.scanObj.getAnotherToken()
             moreThanOne = 1
         if moreThanOne:
-            return [ ('start', AltCode) ] + definition + [ ('end', AltCode) ]
-        else:
-            return definition
+            definition.insert(mark, ('start', AltCode))
+            definition.append( ('end', AltCode) )
 
-    def parseExpr2(self):
-        definition = []
+    def parseExpr2(self, definition):
+        mark = len(definition)
         moreThanOne = 0
         while 1:
-            definition = definition + self.parseExpr3()
+            self.parseExpr3(definition)
             if self.scanObj.token not in ( 'word', 'sqword', 'dqword', 'rule', 'list', '(', '[' ):
                 break
             moreThanOne = 1
         if moreThanOne:
-            return [ ('start', SeqCode) ] + definition + [ ('end', SeqCode) ]
-        else:
-            return definition
+            definition.insert(mark, ('start', SeqCode))
+            definition.append( ('end', SeqCode) )
 
-    def parseExpr3(self):
-        definition = self.parseExpr4()
+    def parseExpr3(self, definition):
+        mark = len(definition)
+        self.parseExpr4(definition)
         if self.scanObj.token == '+':
             self.scanObj.getAnotherToken()
-            return [ ('start', RepCode) ] + definition + [ ('end', RepCode) ]
-        else:
-            return definition
+            definition.insert(mark, ('start', RepCode))
+            definition.append( ('end', RepCode) )
 
-    def parseExpr4(self):
+    def parseExpr4(self, definition):
         if self.scanObj.token in ['word', 'sqword', 'dqword']:
             wordName = self.scanObj.value
             if not wordName:
@@ -516,7 +684,7 @@ class GramParser(object):
                 self.nextWord = self.nextWord + 1
                 self.knownWords[wordName] = wordNumber
             self.scanObj.getAnotherToken()
-            return [ ( 'word', wordNumber ) ]
+            definition.append( ( 'word', wordNumber ) )
                 
         elif self.scanObj.token == 'list':
             listName = self.scanObj.value
@@ -531,7 +699,7 @@ class GramParser(object):
                 self.nextList = self.nextList + 1
                 self.knownLists[listName] = listNumber
             self.scanObj.getAnotherToken()
-            return [ ( 'list', listNumber ) ]
+            definition.append( ( 'list', listNumber ) )
                 
         elif self.scanObj.token == 'rule':
             ruleName = self.scanObj.value
@@ -546,20 +714,19 @@ class GramParser(object):
                 self.nextRule = self.nextRule + 1
                 self.knownRules[ruleName] = ruleNumber
             self.scanObj.getAnotherToken()
-            return [ ( 'rule', ruleNumber ) ]
+            definition.append( ( 'rule', ruleNumber ) )
                 
         elif self.scanObj.token == '(':
             self.scanObj.getAnotherToken()
-            definition = self.parseExpr()
+            self.parseExpr(definition)
             self.scanObj.testAndEatToken(')')
-            return definition
 
         elif self.scanObj.token == '[':
             self.scanObj.getAnotherToken()
-            definition = self.parseExpr()
+            definition.append( ('start', OptCode) )
+            self.parseExpr(definition)
             self.scanObj.testAndEatToken(']')
-            #self.reportOptionalRule(definition)
-            return [ ('start', OptCode) ] + definition + [ ('end', OptCode) ]
+            definition.append( ('end', OptCode) )
 
         else:
             raise SyntaxError( "expecting expression (word, rule, etc.)", self.scanObj)
@@ -679,6 +846,59 @@ class GramParser(object):
             for element in self.ruleDefines[name]:
                 print "      ", element[0], element[1]
 
+#
+# A rule definition (a list of elements, as in ruleDefines) can be converted
+# into a tree and back, which is handier for analysing or changing grammars
+# (see gramoptimizer.py).  In the tree a word, list or rule element is the
+# element tuple itself, like ('word', 3), and a group is a tuple
+# (code, children), with code one of SeqCode, AltCode, RepCode or OptCode and
+# children a tuple of nodes.  So the tree of
+#   [('start', AltCode), ('word', 1), ('word', 2), ('end', AltCode)]
+# is
+#   (AltCode, (('word', 1), ('word', 2)))
+#
+# The nodes are tuples, so identical subtrees compare (and hash) equal.
+#
+
+def ruleDefinitionToTree(definition):
+    """convert a rule definition (list of elements) into a tree
+
+    raises ValueError if the start and end elements do not match
+    """
+    stack = [[]]
+    codes = []
+    for element in definition:
+        kind = element[0]
+        if kind == 'start':
+            stack.append([])
+            codes.append(element[1])
+        elif kind == 'end':
+            if not codes or codes[-1] != element[1]:
+                raise ValueError('ruleDefinitionToTree, unexpected end element: %s'% repr(element))
+            children = stack.pop()
+            stack[-1].append( (codes.pop(), tuple(children)) )
+        else:
+            stack[-1].append(element)
+    if codes:
+        raise ValueError('ruleDefinitionToTree, missing end element(s) in: %s'% repr(definition))
+    if len(stack[0]) == 1:
+        return stack[0][0]
+    return (SeqCode, tuple(stack[0]))
+
+def ruleTreeToDefinition(tree, definition=None):
+    """convert a tree back into a rule definition (list of elements)
+    """
+    if definition is None:
+        definition = []
+    if type(tree[0]) == int:
+        definition.append( ('start', tree[0]) )
+        for child in tree[1]:
+            ruleTreeToDefinition(child, definition)
+        definition.append( ('end', tree[0]) )
+    else:
+        definition.append(tree)
+    return definition
+
 #
 # This function takes a GramParser class which contains the parse of a grammar
 # and returns a "string" object which contains the binary representation of
@@ -693,7 +913,117 @@ class GramParser(object):
 # defined rule.
 #
 
+# The packing is done by GramPacker, which packs each entry and each rule
+# definition with one struct call (the Struct objects for the name lengths
+# are made once) and joins the parts of the binary once at the end.
+#
+# Note: the sizes in the headers are SAPI sizes (DWORD is 4 bytes), while
+# the packing is done with native sizes ("L"), exactly like the original
+# implementation (packGrammarConcat below).
+#
+
+sizeLL = struct.calcsize("LL")
+sizeElement = struct.calcsize("HHL")
+elementTypes = { 'start':1, 'end':2, 'word':3, 'rule':4, 'list':6 }
+
+# Struct "LL%ds" per padded name length, for the entries of the chunks:
+entryStructs = {}
+
+def getEntryStruct(paddedLen):
+    try:
+        return entryStructs[paddedLen]
+    except KeyError:
+        entryStruct = entryStructs[paddedLen] = struct.Struct("LL%ds" % paddedLen)
+        return entryStruct
+
+class GramPacker(object):
+    """pack a grammar binary (or chunks of it), joining the parts once
+
+    header: (dwType, dwFlags) of the header, or None for chunks only.
+    addChunk(type, dict) adds a chunk of names and numbers (like packGrammarChunk),
+    addRules(type, names, dict) adds the chunk of rule definitions (like packGrammarRules),
+    getBinary() returns the binary (a string).
+
+    The output is byte identical to the string concatenation functions
+    packGrammarConcat, packGrammarChunkConcat and packGrammarRulesConcat.
+    """
+    def __init__(self, header=(0, 0)):
+        if header is None:
+            self.parts = []
+        else:
+            self.parts = [pack("LL", header[0], header[1])]
+
+    def addChunk(self, type, dict):
+        parts = self.parts
+        # the chunk header is filled in when the size is known:
+        headerIndex = len(parts)
+        parts.append(None)
+        append = parts.append
+        totalLen = 0
+        for word, number in dict.iteritems():
+            # entry: dwSize, dwNum, szName (zero-term'd and padded to dword)
+            paddedLen = ( len(word) + 4 ) & 0xFFFC
+            append(getEntryStruct(paddedLen).pack(paddedLen+8, number, word))
+            totalLen += paddedLen+8
+        # chunk header: dwChunkID, dwChunkSize (not including this header)
+        parts[headerIndex] = pack("LL", type, totalLen)
+
+    def addRules(self, type, names, dict):
+        parts = self.parts
+        headerIndex = len(parts)
+        parts.append(None)
+        append = parts.append
+        totalLen = 0
+        for word, definition in dict.iteritems():
+            n = len(definition)
+            # rule definition: dwSize, dwNum, followed by the elements
+            # wType, wProb (0), dwValue, all in one call:
+            values = [n*8+8, names[word]]
+            extend = values.extend
+            for kind, number in definition:
+                extend( (elementTypes[kind], 0, number) )
+            append(pack("LL" + "HHL"*n, *values))
+            totalLen += n*8+8
+        parts[headerIndex] = pack("LL", type, totalLen)
+
+    def getBinary(self):
+        return ''.join(self.parts)
+
 def packGrammar(parseObj):
+    # header:
+    #   DWORD dwType  = 0
+    #   DWORD dwFlags = 0
+    packer = GramPacker( (0, 0) )
+
+    # various chunks
+    if len(parseObj.exportRules):
+        packer.addChunk(4, parseObj.exportRules)
+    if len(parseObj.importRules):
+        packer.addChunk(5, parseObj.importRules)
+    if len(parseObj.knownLists):
+        packer.addChunk(6, parseObj.knownLists)
+    if len(parseObj.knownWords):
+        packer.addChunk(2, parseObj.knownWords)
+    if len(parseObj.ruleDefines):
+        packer.addRules(3, parseObj.knownRules, parseObj.ruleDefines)
+    return packer.getBinary()
+
+def packGrammarChunk(type,dict):
+    packer = GramPacker(None)
+    packer.addChunk(type, dict)
+    return packer.getBinary()
+
+def packGrammarRules(type,names,dict):
+    packer = GramPacker(None)
+    packer.addRules(type, names, dict)
+    return packer.getBinary()
+
+#
+# The original implementations, which build the binary by string
+# concatenation.  They are kept as reference for checking GramPacker.
+#
+
+def packGrammarConcat(parseObj):
     output = ""
 
     # header:
@@ -703,19 +1033,19 @@ def packGrammar(parseObj):
 
     # various chunks
     if len(parseObj.exportRules):
-        output = output + packGrammarChunk(4, parseObj.exportRules)
+        output = output + packGrammarChunkConcat(4, parseObj.exportRules)
     if len(parseObj.importRules):
-        output = output + packGrammarChunk(5, parseObj.importRules)
+        output = output + packGrammarChunkConcat(5, parseObj.importRules)
     if len(parseObj.knownLists):
-        output = output + packGrammarChunk(6, parseObj.knownLists)
+        output = output + packGrammarChunkConcat(6, parseObj.knownLists)
     if len(parseObj.knownWords):
-        output = output + packGrammarChunk(2, parseObj.knownWords)
+        output = output + packGrammarChunkConcat(2, parseObj.knownWords)
     if len(parseObj.ruleDefines):
-        output = output + packGrammarRules(3, parseObj.knownRules, parseObj.ruleDefines)
+        output = output + packGrammarRulesConcat(3, parseObj.knownRules, parseObj.ruleDefines)
     return output
 
 
-def packGrammarChunk(type,dict):
+def packGrammarChunkConcat(type,dict):
     output = ""
     totalLen = 0
 
@@ -734,7 +1064,7 @@ def packGrammarChunk(type,dict):
     return pack( "LL", type, totalLen ) + output
 
 
-def packGrammarRules(type,names,dict):
+def packGrammarRulesConcat(type,names,dict):
     output = ""
     totalLen = 0
     elemType = { 'start':1, 'end':2, 'word':3, 'rule':4, 'list':6 }
@@ -762,21 +1092,209 @@ def packGrammarRules(type,names,dict):
     #   DWORD dwChunkSize = number of bytes in chunk not including this header
     return pack( "LL", type, totalLen ) + output
 
+#
+# The reverse of packGrammar: unpackGrammar decodes a grammar binary (made by
+# packGrammar, or by makeGrammar of SelectGramBase or DictGramBase in
+# natlinkutils) back into the dict structures of GramParser.  As in the
+# packing, the sizes in the binary are SAPI sizes, the integers are native.
+#
+# Rules which are not exported or imported have no name in the binary, so
+# the rule definitions are given by rule number (ruleDefinesByNumber).
+#
+# verifyGrammarBinary checks the binary of a parsed grammar against the
+# parse, by decoding it again.
+#
+
+elementNames = { 1:'start', 2:'end', 3:'word', 4:'rule', 6:'list' }
+chunkNames = { 2:'knownWords', 3:'ruleDefines', 4:'exportRules', 5:'importRules',
+               6:'knownLists', 0x1017:'selectWords', 0x1018:'throughWords' }
+
+class UnpackedGrammar(object):
+    """the contents of a grammar binary, see unpackGrammar
+
+    gramType, flags: from the header (0 for command grammars, 2 for
+        dictation grammars and 10 for selection grammars)
+    exportRules, importRules, knownLists, knownWords, selectWords,
+    throughWords: dicts {name: number} of the chunks (empty if not present)
+    knownRules: {name: number} of the rules with a name (exported and imported)
+    ruleDefinesByNumber: {ruleNumber: definition}, with the definition as in
+        GramParser.ruleDefines
+    chunkSizes: {chunkName: number of bytes, including the chunk header}
+    size: total number of bytes of the binary
+    """
+    def __init__(self):
+        self.gramType = self.flags = None
+        self.exportRules = {}
+        self.importRules = {}
+        self.knownLists = {}
+        self.knownWords = {}
+        self.selectWords = {}
+        self.throughWords = {}
+        self.knownRules = {}
+        self.ruleDefinesByNumber = {}
+        self.chunkSizes = {}
+        self.size = 0
+
+    def dumpString(self):
+        """returns the parts that are non empty (like GramParser.dumpString)
+        """
+        L = ['gramType: %s, flags: %s, size: %s'% (self.gramType, self.flags, self.size)]
+        for name in ["knownRules", "knownLists", "knownWords", "exportRules",
+                     "importRules", "selectWords", "throughWords",
+                     "ruleDefinesByNumber", "chunkSizes"]:
+            var = getattr(self, name)
+            if var:
+                L.append(name + ":")
+                L.append(pprint.pformat(var))
+        return '\n'.join(L)
+
+def unpackGrammar(binary):
+    """decode a grammar binary, returns an UnpackedGrammar instance
+
+    raises ValueError if the binary is not a valid grammar binary
+    """
+    binary = str(binary)
+    result = UnpackedGrammar()
+    length = len(binary)
+    if length < sizeLL:
+        raise ValueError('unpackGrammar, binary too short for header: %s bytes'% length)
+    result.gramType, result.flags = struct.unpack_from("LL", binary, 0)
+    result.size = length
+    offset = sizeLL
+    while offset < length:
+        if offset + sizeLL > length:
+            raise ValueError('unpackGrammar, incomplete chunk header at offset %s'% offset)
+        chunkType, chunkLen = struct.unpack_from("LL", binary, offset)
+        chunkStart = offset
+        offset += sizeLL
+        if chunkType not in chunkNames:
+            raise ValueError('unpackGrammar, invalid chunk type %s at offset %s'% (chunkType, chunkStart))
+        if chunkType == 3:
+            offset = unpackGrammarRules(binary, offset, chunkLen, result.ruleDefinesByNumber)
+        else:
+            D = getattr(result, chunkNames[chunkType])
+            offset = unpackGrammarChunk(binary, offset, chunkLen, D)
+        name = chunkNames[chunkType]
+        result.chunkSizes[name] = result.chunkSizes.get(name, 0) + offset - chunkStart
+    for name in result.exportRules:
+        result.knownRules[name] = result.exportRules[name]
+    for name in result.importRules:
+        result.knownRules[name] = result.importRules[name]
+    return result
+
+def unpackGrammarChunk(binary, offset, chunkLen, dict):
+    """decode the entries of a names chunk into dict, returns the new offset
+    """
+    length = len(binary)
+    done = 0
+    while done < chunkLen:
+        if offset + sizeLL > length:
+            raise ValueError('unpackGrammar, incomplete entry at offset %s'% offset)
+        entrySize, number = struct.unpack_from("LL", binary, offset)
+        paddedLen = entrySize - 8
+        if paddedLen <= 0 or offset + sizeLL + paddedLen > length:
+            raise ValueError('unpackGrammar, invalid entry size %s at offset %s'% (entrySize, offset))
+        offset += sizeLL
+        name = binary[offset:offset+paddedLen].split('\0', 1)[0]
+        dict[name] = number
+        offset += paddedLen
+        done += entrySize
+    if done != chunkLen:
+        raise ValueError('unpackGrammar, chunk size %s does not match its entries (%s)'% (chunkLen, done))
+    return offset
+
+def unpackGrammarRules(binary, offset, chunkLen, dict):
+    """decode the rule definitions chunk into dict (by rule number), returns the new offset
+    """
+    length = len(binary)
+    done = 0
+    while done < chunkLen:
+        if offset + sizeLL > length:
+            raise ValueError('unpackGrammar, incomplete rule at offset %s'% offset)
+        ruleSize, number = struct.unpack_from("LL", binary, offset)
+        n, rest = divmod(ruleSize - 8, 8)
+        if n < 0 or rest or offset + sizeLL + n*sizeElement > length:
+            raise ValueError('unpackGrammar, invalid rule size %s at offset %s'% (ruleSize, offset))
+        offset += sizeLL
+        values = struct.unpack_from("HHL"*n, binary, offset)
+        definition = []
+        for i in range(0, 3*n, 3):
+            try:
+                definition.append( (elementNames[values[i]], values[i+2]) )
+            except KeyError:
+                raise ValueError('unpackGrammar, invalid element type %s in rule %s'% (values[i], number))
+        dict[number] = definition
+        offset += n*sizeElement
+        done += ruleSize
+    if done != chunkLen:
+        raise ValueError('unpackGrammar, chunk size %s does not match its rules (%s)'% (chunkLen, done))
+    return offset
+
+def verifyGrammarBinary(parseObj, binary=None):
+    """check the binary of a parsed grammar by decoding it again
+
+    binary: the binary to check, default packGrammar(parseObj)
+    returns a list of the differences found (empty if all is well).
+    The binary is also compared with the reference packer (packGrammarConcat).
+    """
+    if binary is None:
+        binary = packGrammar(parseObj)
+    try:
+        unpacked = unpackGrammar(binary)
+    except ValueError, message:
+        return [str(message)]
+    L = []
+    if (unpacked.gramType, unpacked.flags) != (0, 0):
+        L.append('header: %s, %s, expected 0, 0'% (unpacked.gramType, unpacked.flags))
+    for name in ['exportRules', 'importRules', 'knownLists', 'knownWords']:
+        expected, got = getattr(parseObj, name), getattr(unpacked, name)
+        if expected != got:
+            L.append('%s: %s, expected %s'% (name, got, expected))
+    expectedDefines = {}
+    ruleNames = {}
+    for ruleName, definition in parseObj.ruleDefines.items():
+        number = parseObj.knownRules[ruleName]
+        expectedDefines[number] = definition
+        ruleNames[number] = ruleName
+    for number in expectedDefines:
+        if number not in unpacked.ruleDefinesByNumber:
+            L.append('rule %s (%s) missing in binary'% (number, ruleNames[number]))
+        elif unpacked.ruleDefinesByNumber[number] != expectedDefines[number]:
+            L.append('rule %s (%s): %s, expected %s'% (number, ruleNames[number],
+                                                       unpacked.ruleDefinesByNumber[number],
+                                                       expectedDefines[number]))
+    for number in unpacked.ruleDefinesByNumber:
+        if number not in expectedDefines:
+            L.append('rule %s in binary was not defined'% number)
+    if binary != packGrammarConcat(parseObj):
+        L.append('binary differs from the reference packer (packGrammarConcat)')
+    return L
+
 #
 # This is a routine which was included for testing but can also be used to 
 # compile grammar files.  It takes an input file name containing a grammar 
 # and an output file name to write the binary into.
 #
+# The grammar is normalized like in GrammarBase.load, and the binary is
+# checked with verifyGrammarBinary before it is written.
+#
 
 def parseGrammarAndSave(inName,outName):
     inFile = open(inName,'r')
-    parseObj = GramParser()
-    parseObj.doParse( inFile.readlines() )
+    lines = inFile.readlines()
     inFile.close()
-    binary = gramparser.packGrammar(parseObj)
+    splitApartLines(lines)
+    grammarName = os.path.splitext(os.path.basename(inName))[0]
+    parseObj = GramParser(lines, grammarName=grammarName)
+    parseObj.doParse()
+    parseObj.checkForErrors()
+    binary = packGrammar(parseObj)
+    differences = verifyGrammarBinary(parseObj, binary)
+    if differences:
+        raise GrammarError("packed grammar does not match the parse:\n%s"% '\n'.join(differences),
+                           parseObj.scanObj)
     outFile = open(outName,'wb')
     outFile.write( binary )
-    outFile.write( "hello" )
     outFile.close()
 
 def isCharOrDigit(ch):
@@ -858,6 +1376,159 @@ def splitApartLines(lines):
         
 
 
+#
+# The grammars of a grammar module can be found without importing the module
+# (which would need natlink and would run its load code): the assignments to
+# gramSpec, at module level and in the classes, are evaluated when they
+# consist of string constants, concatenations of those, or lists of them.
+# Names of module level string constants are also resolved.
+#
+
+def extractGramSpecsFromFile(path):
+    """return a list of (className, gramSpec) tuples found in a python file
+
+    className is "" for a gramSpec at module level.  gramSpec is always a
+    list of strings (not yet passed through splitApartLines).  gramSpec's
+    that are not constant (eg made with % or function calls) are skipped, a
+    file that cannot be read or compiled gives an empty list.
+    """
+    try:
+        source = open(path, 'rU').read()
+        tree = ast.parse(source, path)
+    except Exception:
+        return []
+    result = []
+    constants = {}
+    def visitBody(body, className):
+        for node in body:
+            if isinstance(node, ast.ClassDef):
+                visitBody(node.body, node.name)
+            elif isinstance(node, ast.Assign):
+                value = evalConstantStrings(node.value, constants)
+                for target in node.targets:
+                    if not isinstance(target, ast.Name):
+                        continue
+                    if target.id == 'gramSpec':
+                        if value is not None:
+                            if type(value) != list:
+                                value = [value]
+                            result.append((className, value))
+                    elif not className and value is not None:
+                        constants[target.id] = value
+    visitBody(tree.body, "")
+    return result
+
+def evalConstantStrings(node, constants):
+    """value of a string (list) expression in an ast, None if not constant"""
+    if isinstance(node, ast.Str):
+        return node.s
+    if isinstance(node, ast.Name):
+        return constants.get(node.id, None)
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [evalConstantStrings(elt, constants) for elt in node.elts]
+        if None in values or [v for v in values if type(v) not in (str, unicode)]:
+            return None
+        return values
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = evalConstantStrings(node.left, constants)
+        right = evalConstantStrings(node.right, constants)
+        if left is None or right is None:
+            return None
+        if type(left) == list or type(right) == list:
+            if type(left) == list and type(right) == list:
+                return left + right
+            return None
+        return left + right
+    return None
+
+
+#
+# The following routines compare and time the scanners on a grammar, for
+# example a large generated one:
+#
+#   >>> gramSpec = makeAlternativesGrammar(5000)
+#   >>> benchmarkScanners(gramSpec)
+#   {'GramScanner': <seconds>, 'GramScannerRegex': <seconds>}
+#
+
+def makeAlternativesGrammar(nAlternatives, perLine=10):
+    """make a grammar with one exported rule with nAlternatives alternatives
+
+    like the grammars of code generators, the alternatives contain plain
+    and quoted words, optional and repeated parts, rules and lists.
+    """
+    L = ['<dgndictation> imported;',
+         '<number> = one | two | three;',
+         '<command> exported =']
+    alts = []
+    for i in range(nAlternatives):
+        if i%4 == 0:
+            alts.append('word%s <number>'% i)
+        elif i%4 == 1:
+            alts.append('"quoted word%s" [please]'% i)
+        elif i%4 == 2:
+            alts.append("(go | move) to%s {list%s}+"% (i, i%10))
+        else:
+            alts.append('dictate%s <dgndictation>'% i)
+    for i in range(0, nAlternatives, perLine):
+        prefix = i and '  | ' or '    '
+        L.append(prefix + ' | '.join(alts[i:i+perLine]) + '  # line %s'% (i/perLine))
+    L.append('  ;')
+    return L
+
+def scanTokens(gramSpec, scannerClass=GramScanner):
+    """return the tokens of a grammar as a list of (token, value, line, start, char)
+    """
+    scanObj = scannerClass(gramSpec)
+    tokens = []
+    while scanObj.token != '\0':
+        scanObj.getAnotherToken()
+        tokens.append( (scanObj.token, scanObj.value, scanObj.line,
+                        scanObj.start, scanObj.char) )
+    return tokens
+
+def benchmarkScanners(gramSpec, scannerClasses=None, count=3):
+    """time the scanners on a grammar and check they give the same tokens
+
+    returns a dict with the best time (in seconds) of each scanner class
+    """
+    import time
+    scannerClasses = scannerClasses or [GramScanner, GramScannerRegex]
+    D = {}
+    expected = None
+    for scannerClass in scannerClasses:
+        best = None
+        for i in range(count):
+            t0 = time.clock()
+            tokens = scanTokens(gramSpec, scannerClass)
+            elapsed = time.clock() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+        if expected is None:
+            expected = tokens
+        elif tokens != expected:
+            raise ValueError('benchmarkScanners, %s gives other tokens than %s'%
+                             (scannerClass.__name__, scannerClasses[0].__name__))
+        D[scannerClass.__name__] = best
+    return D
+
+def benchmarkParser(sizes=(500, 1000, 2000, 4000, 8000), scannerClass=None):
+    """time the parsing of grammars with an increasing number of alternatives
+
+    returns a list of (nAlternatives, seconds, microseconds per alternative),
+    the last column should stay (about) constant when the size grows.
+    """
+    import time
+    L = []
+    for n in sizes:
+        gramSpec = makeAlternativesGrammar(n)
+        parser = GramParser(gramSpec, scannerClass=scannerClass)
+        t0 = time.clock()
+        parser.doParse()
+        elapsed = time.clock() - t0
+        L.append( (n, elapsed, elapsed*1e6/n) )
+    return L
+
 test = """
 >>> gramSpec = ['<rule> exported = action;']
 >>> parser = GramParser(gramSpec)
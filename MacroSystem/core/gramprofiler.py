@@ -0,0 +1,399 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# gramprofiler.py
+#   This module reports on the complexity of command grammars, in order to
+#   find the grammars that make recognition slow.
+#
+# profileGrammar(parseObj) analyses a parsed grammar (a GramParser object
+# after doParse) and returns a RuleProfile for each exported rule, with:
+#
+#   formula     the number of distinct word sequences, as a formula.  Lists
+#               of unknown size are written as L(name), imported rules as
+#               <name>, and a repeat of x as R(x), being x + x^2 + ... + x^k
+#               for at most k repetitions.
+#   sequences   this number computed with k = maxRepeat (default 2), and
+#               each list of unknown size and each imported rule counted as 1
+#   unbounded   1 if the rule contains a repeat, <dgndictation> or
+#               <dgnletters>, so the real number of sequences is unlimited
+#   depth       the maximum nesting of groups and rule references
+#   branching   for each word position (up to maxPositions, default 8) the
+#               number of different words that can be spoken at that
+#               position, a list counting as its size
+#   lists       {listName: size} of the lists used (size None if unknown)
+#   imports     the imported rules used (eg dgndictation, dgnletters)
+#   cost        the sum of the branching factors, with each imported rule
+#               counted as importedCost (default 1000, open vocabulary).
+#               This is a rough measure of the work of the recognizer for
+#               this rule.
+#
+# The positions are found with the Glushkov construction (first and follow
+# sets of the words of the rule), referenced rules being expanded in place.
+#
+# rankLoadedGrammars() profiles all grammars that are loaded and sorts
+# them by total cost, highest first.  The same can be done from the command
+# line for a directory of grammar modules (without importing the modules):
+#
+#   python gramprofiler.py [directory [maxGrammars]]
+#
+import sys, os, os.path
+import gramparser
+from gramparser import SeqCode, AltCode, RepCode, OptCode, ruleDefinitionToTree
+
+# imported rules that stand for open vocabulary (one or more words):
+dictationRules = ('dgndictation', 'dgnletters')
+
+class RuleProfile(object):
+    """the complexity figures of one exported rule, see the top of this file
+    """
+    def __init__(self, ruleName):
+        self.ruleName = ruleName
+        self.formula = 1
+        self.sequences = 1
+        self.unbounded = 0
+        self.depth = 0
+        self.branching = []
+        self.lists = {}
+        self.imports = []
+        self.cost = 0
+
+    def dumpString(self):
+        lists = ', '.join(['%s: %s'% (k, v) for k, v in sorted(self.lists.items())])
+        return '<%s>: cost %s, sequences %s%s (%s), depth %s, branching %s%s%s'% \
+               (self.ruleName, self.cost, self.sequences, self.unbounded and '+' or '',
+                self.formula, self.depth, self.branching,
+                lists and ', lists {%s}'% lists or '',
+                self.imports and ', imports %s'% ', '.join(self.imports) or '')
+
+class GrammarProfiler(object):
+    """profiles the exported rules of a GramParser object
+
+    listSizes: {listName: number of words}, lists not in here have unknown size
+    """
+    def __init__(self, parseObj, listSizes=None, maxRepeat=2, maxPositions=8,
+                 importedCost=1000):
+        self.parseObj = parseObj
+        self.listSizes = listSizes or {}
+        self.maxRepeat = maxRepeat
+        self.maxPositions = maxPositions
+        self.importedCost = importedCost
+        self.wordNames = dict([(v,k) for k,v in parseObj.knownWords.items()])
+        self.listNames = dict([(v,k) for k,v in parseObj.knownLists.items()])
+        self.ruleNames = dict([(v,k) for k,v in parseObj.knownRules.items()])
+        self.trees = {}
+
+    def getTree(self, ruleName):
+        if ruleName not in self.trees:
+            self.trees[ruleName] = ruleDefinitionToTree(self.parseObj.ruleDefines[ruleName])
+        return self.trees[ruleName]
+
+    def profile(self):
+        """return {ruleName: RuleProfile} for all exported rules"""
+        result = {}
+        for ruleName in self.parseObj.exportRules.keys():
+            result[ruleName] = self.profileRule(ruleName)
+        return result
+
+    def profileRule(self, ruleName):
+        prof = RuleProfile(ruleName)
+        if ruleName not in self.parseObj.ruleDefines:
+            # an exported imported rule, nothing to analyse:
+            prof.imports = [ruleName]
+            prof.unbounded = ruleName in dictationRules
+            prof.formula = '<%s>'% ruleName
+            prof.cost = self.importedCost
+            return prof
+        self.profileObj = prof
+        self.positions = []     # (kind, name) for each word position
+        self.follow = []        # set of following positions for each position
+        tree = self.getTree(ruleName)
+        prof.formula, prof.sequences = self.countSequences(tree, [ruleName])
+        prof.depth = self.getDepth(tree, [ruleName])
+        nullable, first, last = self.buildPositions(tree, [ruleName])
+        prof.branching = self.getBranching(first)
+        prof.imports.sort()
+        prof.cost = 0
+        for states in self.getStates(first):
+            for kind, name in set([self.positions[p] for p in states]):
+                if kind == 'rule':
+                    prof.cost += self.importedCost
+                elif kind == 'list':
+                    prof.cost += self.listSizes.get(name, 1)
+                else:
+                    prof.cost += 1
+        return prof
+
+    # number of word sequences, as a formula and as a number.  A formula is
+    # a number or a string.
+
+    def countSequences(self, node, stack):
+        kind = node[0]
+        if kind == 'word':
+            return 1, 1
+        if kind == 'list':
+            listName = self.listNames[node[1]]
+            size = self.listSizes.get(listName, None)
+            self.profileObj.lists[listName] = size
+            if size is None:
+                return 'L(%s)'% listName, 1
+            return size, size
+        if kind == 'rule':
+            ruleName = self.ruleNames[node[1]]
+            if ruleName not in self.parseObj.ruleDefines or ruleName in stack:
+                if ruleName not in self.parseObj.ruleDefines and \
+                       ruleName not in self.profileObj.imports:
+                    self.profileObj.imports.append(ruleName)
+                if ruleName in dictationRules:
+                    self.profileObj.unbounded = 1
+                return '<%s>'% ruleName, 1
+            return self.countSequences(self.getTree(ruleName), stack + [ruleName])
+        counts = [self.countSequences(child, stack) for child in node[1]]
+        formulas = [c[0] for c in counts]
+        numbers = [c[1] for c in counts]
+        if kind == SeqCode:
+            number = 1
+            for n in numbers:
+                number *= n
+            return formulaProduct(formulas), number
+        if kind == AltCode:
+            return formulaSum(formulas), sum(numbers)
+        if kind == OptCode:
+            formula, number = formulaProduct(formulas), reduce(lambda a, b: a*b, numbers, 1)
+            return formulaSum([formula, 1]), number + 1
+        if kind == RepCode:
+            self.profileObj.unbounded = 1
+            formula, number = formulaProduct(formulas), reduce(lambda a, b: a*b, numbers, 1)
+            total = 0
+            for i in range(1, self.maxRepeat+1):
+                total += number**i
+            return 'R(%s)'% formula, total
+        raise ValueError("invalid element in rule tree: %s"% repr(node))
+
+    def getDepth(self, node, stack):
+        kind = node[0]
+        if kind == 'rule':
+            ruleName = self.ruleNames[node[1]]
+            if ruleName not in self.parseObj.ruleDefines or ruleName in stack:
+                return 0
+            return 1 + self.getDepth(self.getTree(ruleName), stack + [ruleName])
+        if type(kind) != int:
+            return 0
+        return 1 + max([self.getDepth(child, stack) for child in node[1]])
+
+    # Glushkov positions: each word, list or imported rule in the (expanded)
+    # tree is a position.  buildPositions returns (nullable, first, last) of
+    # a node, and fills self.positions and self.follow.
+
+    def buildPositions(self, node, stack):
+        kind = node[0]
+        if kind == 'rule':
+            ruleName = self.ruleNames[node[1]]
+            if ruleName in self.parseObj.ruleDefines and ruleName not in stack:
+                return self.buildPositions(self.getTree(ruleName), stack + [ruleName])
+        if type(kind) != int:
+            p = len(self.positions)
+            if kind == 'word':
+                self.positions.append(('word', self.wordNames[node[1]]))
+            elif kind == 'list':
+                self.positions.append(('list', self.listNames[node[1]]))
+            else:
+                self.positions.append(('rule', self.ruleNames[node[1]]))
+            self.follow.append(set())
+            if kind == 'rule' and self.ruleNames[node[1]] in dictationRules:
+                self.follow[p].add(p)  # one or more words
+            return 0, set([p]), set([p])
+        children = [self.buildPositions(child, stack) for child in node[1]]
+        if kind == SeqCode:
+            nullable, first, last = 1, set(), set()
+            for childNullable, childFirst, childLast in children:
+                for p in last:
+                    self.follow[p] |= childFirst
+                if nullable:
+                    first |= childFirst
+                if childNullable:
+                    last = last | childLast
+                else:
+                    last = set(childLast)
+                nullable = nullable and childNullable
+            return nullable, first, last
+        if kind == AltCode:
+            nullable, first, last = 0, set(), set()
+            for childNullable, childFirst, childLast in children:
+                nullable = nullable or childNullable
+                first |= childFirst
+                last |= childLast
+            return nullable, first, last
+        # repeat and optional have one child (a sequence after parsing, but
+        # be prepared for more):
+        nullable, first, last = self.buildPositions((SeqCode, node[1]), stack)
+        if kind == RepCode:
+            for p in last:
+                self.follow[p] |= first
+        else:
+            nullable = 1
+        return nullable, first, last
+
+    def getStates(self, first):
+        """yield the set of positions for each word position"""
+        states = first
+        for i in range(self.maxPositions):
+            if not states:
+                return
+            yield states
+            nextStates = set()
+            for p in states:
+                nextStates |= self.follow[p]
+            states = nextStates
+
+    def getBranching(self, first):
+        branching = []
+        for states in self.getStates(first):
+            n = 0
+            for kind, name in set([self.positions[p] for p in states]):
+                if kind == 'list':
+                    n += self.listSizes.get(name, 1)
+                else:
+                    n += 1
+            branching.append(n)
+        return branching
+
+# helper functions for the sequence formulas:
+
+def formulaProduct(formulas):
+    number = 1
+    symbols = []
+    for f in formulas:
+        if type(f) in (int, long):
+            number *= f
+        else:
+            symbols.append(f)
+    if not symbols or number == 0:
+        return number
+    symbols = [(' + ' in s and '(%s)'% s or s) for s in symbols]
+    if number != 1:
+        symbols.insert(0, str(number))
+    return '*'.join(symbols)
+
+def formulaSum(formulas):
+    number = 0
+    symbols = []
+    for f in formulas:
+        if type(f) in (int, long):
+            number += f
+        else:
+            symbols.append(f)
+    if not symbols:
+        return number
+    if number:
+        symbols.append(str(number))
+    return ' + '.join(symbols)
+
+def profileGrammar(parseObj, listSizes=None, **kw):
+    """return {ruleName: RuleProfile} for the exported rules of a parsed grammar
+
+    the keyword arguments maxRepeat, maxPositions and importedCost are passed
+    to GrammarProfiler.
+    """
+    return GrammarProfiler(parseObj, listSizes, **kw).profile()
+
+def profileGramSpec(gramSpec, listSizes=None, grammarName=None, **kw):
+    """parse a gramSpec (string or list of strings) and profile it"""
+    if type(gramSpec) in (str, unicode):
+        gramSpec = [gramSpec]
+    gramSpec = list(gramSpec)
+    gramparser.splitApartLines(gramSpec)
+    parser = gramparser.GramParser(gramSpec, grammarName=grammarName)
+    parser.doParse()
+    parser.checkForErrors()
+    return profileGrammar(parser, listSizes, **kw)
+
+#
+# ranking of grammars
+#
+
+class GrammarRanking(object):
+    """the profiles of a set of grammars, sorted by total cost
+
+    entries is a list of (cost, name, profiles) tuples, profiles being the
+    {ruleName: RuleProfile} dict of the grammar, highest cost first.
+    errors is a list of (name, message) for grammars that could not be
+    profiled, message being the complete error message (for a parser error
+    the location, the message and the error marker).
+    """
+    def __init__(self):
+        self.entries = []
+        self.errors = []
+
+    def addGramSpec(self, name, gramSpec, listSizes=None, **kw):
+        try:
+            profiles = profileGramSpec(gramSpec, listSizes, grammarName=name, **kw)
+        except gramparser.GrammarParserError, exc:
+            self.errors.append((name, str(exc).rstrip()))
+            return
+        except Exception, exc:
+            # one bad grammar must not stop the ranking of the others:
+            self.errors.append((name, '%s: %s'% (exc.__class__.__name__, exc)))
+            return
+        cost = sum([p.cost for p in profiles.values()])
+        self.entries.append((cost, name, profiles))
+        self.entries.sort(key=lambda e: -e[0])
+
+    def dumpString(self, maxGrammars=None, rules=1):
+        L = []
+        for cost, name, profiles in self.entries[:maxGrammars]:
+            L.append('%8s  %s'% (cost, name))
+            if rules:
+                ruleProfiles = sorted(profiles.values(), key=lambda p: -p.cost)
+                for p in ruleProfiles:
+                    L.append('          %s'% p.dumpString())
+        for name, message in self.errors:
+            lines = message.split('\n')
+            L.append('   error  %s: %s'% (name, lines[0]))
+            for line in lines[1:]:
+                if line.strip():
+                    L.append('          %s'% line)
+        return '\n'.join(L)
+
+def rankLoadedGrammars(**kw):
+    """profile the grammars that are loaded (natlinkutils.loadedGrammars)
+
+    each grammar is profiled with the gramSpec it actually loaded (its
+    scanSource), the list sizes are taken from the grammar objects.
+    Returns a GrammarRanking.
+    """
+    import natlinkutils
+    grammars = []
+    for grammar in list(natlinkutils.loadedGrammars):
+        if not grammar.scanSource:
+            continue
+        gramSpec, grammarName = grammar.scanSource
+        name = grammar.getReportName()
+        if grammarName:
+            name = '%s (%s)'% (name, grammarName)
+        grammars.append( (name, gramSpec, grammar.listSizes) )
+    ranking = GrammarRanking()
+    for name, gramSpec, listSizes in sorted(grammars):
+        ranking.addGramSpec(name, gramSpec, listSizes, **kw)
+    return ranking
+
+def rankDirectory(directory, **kw):
+    """profile the constant gramSpec's in the python files of a directory
+
+    the modules are not imported (see gramparser.extractGramSpecsFromFile),
+    so list sizes are unknown.  Returns a GrammarRanking.
+    """
+    ranking = GrammarRanking()
+    for f in sorted(os.listdir(directory)):
+        if not f.endswith('.py'):
+            continue
+        modName = f[:-3]
+        for className, gramSpec in gramparser.extractGramSpecsFromFile(os.path.join(directory, f)):
+            name = className and '%s.%s'% (modName, className) or modName
+            ranking.addGramSpec(name, gramSpec, **kw)
+    return ranking
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    directory = args and args[0] or os.getcwd()
+    maxGrammars = len(args) > 1 and int(args[1]) or None
+    print rankDirectory(directory).dumpString(maxGrammars)
@@ -0,0 +1,49 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# gramsymbols.py
+#   This module interns the rule and list names that GrammarBase keeps for
+#   each loaded grammar, so grammars with the same names share one string
+#   object.  The builtin intern() is used, so a name is freed again when
+#   no grammar uses it anymore.  Words are not interned.
+#
+#   internSymbol(name)
+#       Return the interned string for name.  Unicode names are returned
+#       as they are (intern() only accepts str).
+#
+#   getObjectSize(obj, seen)
+#       The number of bytes of obj and the objects it contains (dicts,
+#       lists, tuples, sets and instances), each object counted once (seen
+#       is a set of ids).
+#
+import sys, types
+
+def internSymbol(name):
+    if type(name) == str:
+        return intern(name)
+    return name
+
+# objects that are not counted in getObjectSize (code, modules, classes):
+notCounted = (types.ModuleType, types.FunctionType, types.MethodType,
+              types.BuiltinFunctionType, types.ClassType, type)
+
+def getObjectSize(obj, seen=None):
+    """approximate number of bytes held by obj, see top of module"""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, notCounted):
+        return 0
+    seen.add(id(obj))
+    try:
+        size = sys.getsizeof(obj)
+    except TypeError:
+        return 0
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += getObjectSize(k, seen) + getObjectSize(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += getObjectSize(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += getObjectSize(obj.__dict__, seen)
+    return size
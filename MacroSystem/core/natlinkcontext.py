@@ -0,0 +1,291 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# natlinkcontext.py
+#   This module activates the rules of a grammar according to the foreground
+#   window, for use in gotBegin.  Instead of calling matchWindow for each
+#   application and then activateSet, a grammar declares the rules per
+#   context once:
+#
+#   def initialize(self):
+#       self.load(self.gramSpec)
+#       self.contexts = ActivationManager(self)
+#       self.contexts.addContext(['global'])
+#       self.contexts.addContext(['edit', 'search'], 'notepad')
+#       self.contexts.addContext(['mail'], 'outlook', 'Message')
+#
+#   def gotBegin(self, moduleInfo):
+#       self.contexts.update(moduleInfo)
+#
+#   def unload(self):
+#       self.contexts.close()
+#       GrammarBase.unload(self)
+#
+#   addContext( ruleNames, modName=None, wndText=None )
+#       The rules are active when the executable (without path and extension,
+#       compared in lower case, like matchWindow) is modName and the window
+#       title contains wndText (case sensitive).  None (or '') for modName
+#       or wndText matches every executable or title.  The active rules in a
+#       window are the rules of all contexts that match.
+#
+#   update( moduleInfo, exclusive=None )
+#       Activate the rules for moduleInfo (as passed to gotBegin) with
+#       activateSet.  When moduleInfo is the same as at the previous call
+#       nothing is done at all.  The rule set of a window is kept per window
+#       handle (together with its executable and title, so a changed title
+#       is resolved again), at most maxWindows windows, the least recently
+#       used being removed.  The contexts are matched with the shared
+#       windowIndex (see below).  Returns the active rules (a frozenset,
+#       also when nothing was done).
+#
+#   getRules( moduleInfo )
+#       The rules for moduleInfo, without activating them.
+#
+#   invalidate()
+#       Forget the previous moduleInfo, for example after the grammar
+#       activated or deactivated rules itself.  The next update calls
+#       activateSet again.
+#
+#   close()
+#       Remove the contexts from the window index (see below), for example
+#       when the grammar is unloaded.
+#
+# The counters unchanged, hits, misses and evictions can be inspected with
+# getStats().
+#
+# The window patterns of all grammars are kept in one WindowIndex,
+# windowIndex.  It matches a moduleInfo against all patterns in one pass
+# over the window title (an Aho-Corasick automaton of the title
+# substrings), and keeps the result of the last moduleInfo, so during one
+# utterance the title is scanned once for all grammars:
+#
+#   windowIndex.add( owner, item, modName=None, wndText=None )
+#       Register a pattern, modName and wndText as in addContext.  owner is
+#       for example a grammar, item anything hashable.  The owners are kept
+#       by weak reference: the patterns of an owner that is deleted are
+#       removed.
+#
+#   windowIndex.remove( owner )
+#       Remove all patterns of owner.
+#
+#   windowIndex.match( moduleInfo )
+#       Returns a dict {owner: frozenset of items} of all matching patterns.
+#
+#   windowIndex.matchOwner( moduleInfo, owner )
+#       The frozenset of the matching items of one owner.
+#
+import weakref
+from collections import OrderedDict
+from natlinkutils import getBaseName
+
+class WindowIndex(object):
+    """(module name, title substring) patterns of many owners, matched at once
+    """
+    def __init__(self):
+        # weakref of owner: {item: (modName, wndText)}
+        self.patterns = {}
+        self.automaton = None
+        self.always = []  # the patterns without title substring
+        self.lastModuleInfo = None
+        self.lastResult = None
+        self.matches = self.cached = 0
+
+    def add(self, owner, item, modName=None, wndText=None):
+        modName = modName and modName.lower() or None
+        ownerRef = weakref.ref(owner, self.removeRef)
+        self.patterns.setdefault(ownerRef, {})[item] = (modName, wndText or '')
+        self.automaton = None
+
+    def remove(self, owner):
+        self.removeRef(weakref.ref(owner))
+
+    def removeRef(self, ownerRef):
+        """remove the patterns of an owner (also called when it is deleted)"""
+        if self.patterns.pop(ownerRef, None) is not None:
+            self.automaton = None
+            self.lastModuleInfo = self.lastResult = None
+
+    # the automaton: goto (a dict {char: state} per state), fail (the state
+    # of the longest proper suffix that is also a prefix of a pattern) and
+    # output (the numbers of the title substrings that end in each state,
+    # including those of the fail states).  Each title substring has a list
+    # of (modName, weakref of owner, item), the empty substring is matched
+    # always.
+
+    def build(self):
+        texts = {}
+        for ownerRef, items in self.patterns.items():
+            for item, (modName, wndText) in items.items():
+                texts.setdefault(wndText, []).append( (modName, ownerRef, item) )
+        goto, fail, output = [{}], [0], [[]]
+        textEntries = []
+        self.always = []
+        for wndText, entries in texts.items():
+            if not wndText:
+                self.always = entries
+                continue
+            state = 0
+            for c in wndText:
+                nextState = goto[state].get(c)
+                if nextState is None:
+                    nextState = len(goto)
+                    goto[state][c] = nextState
+                    goto.append({})
+                    fail.append(0)
+                    output.append([])
+                state = nextState
+            output[state].append(len(textEntries))
+            textEntries.append(entries)
+        queue = goto[0].values()
+        while queue:
+            newQueue = []
+            for state in queue:
+                for c, nextState in goto[state].items():
+                    f = fail[state]
+                    while f and c not in goto[f]:
+                        f = fail[f]
+                    f = goto[f].get(c, 0)
+                    if f == nextState:
+                        f = 0
+                    fail[nextState] = f
+                    output[nextState] = output[nextState] + output[f]
+                    newQueue.append(nextState)
+            queue = newQueue
+        self.automaton = goto, fail, output, textEntries
+        self.lastModuleInfo = self.lastResult = None
+
+    def scanTitle(self, title):
+        """the numbers of the title substrings that occur in title"""
+        goto, fail, output, textEntries = self.automaton
+        found = set()
+        state = 0
+        for c in title:
+            nextState = goto[state].get(c)
+            while nextState is None and state:
+                state = fail[state]
+                nextState = goto[state].get(c)
+            state = nextState or 0
+            if output[state]:
+                found.update(output[state])
+        return found
+
+    def match(self, moduleInfo):
+        """{owner: frozenset of items} of the owners that are alive"""
+        result = {}
+        for ownerRef, items in self.matchRefs(moduleInfo).items():
+            owner = ownerRef()
+            if owner is not None:
+                result[owner] = items
+        return result
+
+    def matchRefs(self, moduleInfo):
+        """the same as match, with the weak references of the owners as keys"""
+        if self.automaton is None:
+            self.build()
+        moduleInfo = tuple(moduleInfo)
+        if moduleInfo == self.lastModuleInfo:
+            self.cached += 1
+            return self.lastResult
+        self.matches += 1
+        if len(moduleInfo) < 3 or not moduleInfo[0]:
+            modName, title = '', moduleInfo and moduleInfo[1] or ''
+        else:
+            modName, title = getBaseName(moduleInfo[0]).lower(), moduleInfo[1]
+        textEntries = self.automaton[3]
+        entries = list(self.always)
+        for i in self.scanTitle(title):
+            entries.extend(textEntries[i])
+        result = {}
+        for entryModName, ownerRef, item in entries:
+            if entryModName is None or entryModName == modName:
+                result.setdefault(ownerRef, set()).add(item)
+        for ownerRef in result:
+            result[ownerRef] = frozenset(result[ownerRef])
+        self.lastModuleInfo, self.lastResult = moduleInfo, result
+        return result
+
+    def matchOwner(self, moduleInfo, owner):
+        return self.matchRefs(moduleInfo).get(weakref.ref(owner), frozenset())
+
+    def getStats(self):
+        return dict(patterns=sum(map(len, self.patterns.values())), owners=len(self.patterns),
+                    matches=self.matches, cached=self.cached)
+
+windowIndex = WindowIndex()
+
+class ActivationManager(object):
+    """activates the rules of a GrammarBase instance per window
+
+    grammar: a loaded GrammarBase instance (a weak reference is kept, the
+        grammar usually keeps the manager, and a reference cycle through a
+        grammar is never collected, see GramClassBase.__del__)
+    maxWindows: the number of windows whose rule set is kept (default 50)
+    index: the WindowIndex for the contexts, default the shared windowIndex
+    """
+    def __init__(self, grammar, maxWindows=50, index=None):
+        self.grammar = weakref.proxy(grammar)
+        self.maxWindows = maxWindows
+        self.index = index or windowIndex
+        self.contextRules = {}  # (modName, wndText): rules
+        self.windows = OrderedDict()  # hwnd: (modPath, title, rules)
+        self.lastModuleInfo = None
+        self.unchanged = self.hits = self.misses = self.evictions = 0
+
+    def addContext(self, ruleNames, modName=None, wndText=None):
+        if type(ruleNames) in (str, unicode):
+            ruleNames = [ruleNames]
+        context = modName and modName.lower() or None, wndText or ''
+        self.contextRules[context] = self.contextRules.get(context, frozenset()) | \
+                                     frozenset(ruleNames)
+        self.index.add(self, context, context[0], context[1])
+        self.windows.clear()
+        self.lastModuleInfo = None
+
+    def resolve(self, moduleInfo):
+        rules = set()
+        for context in self.index.matchOwner(moduleInfo, self):
+            rules |= self.contextRules[context]
+        return frozenset(rules)
+
+    def getRules(self, moduleInfo):
+        if len(moduleInfo) < 3 or not moduleInfo[0]:
+            return self.resolve(moduleInfo)
+        modPath, title, hwnd = moduleInfo[:3]
+        windows = self.windows
+        try:
+            entry = windows.pop(hwnd)
+        except KeyError:
+            entry = None
+        if entry and entry[0] == modPath and entry[1] == title:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (modPath, title, self.resolve(moduleInfo))
+        windows[hwnd] = entry
+        while len(windows) > self.maxWindows:
+            windows.popitem(last=False)
+            self.evictions += 1
+        return entry[2]
+
+    def update(self, moduleInfo, exclusive=None):
+        moduleInfo = tuple(moduleInfo)
+        if moduleInfo == self.lastModuleInfo:
+            self.unchanged += 1
+            return frozenset(self.grammar.activeRuleSet)
+        rules = self.getRules(moduleInfo)
+        self.grammar.activateSet(rules, exclusive=exclusive)
+        self.lastModuleInfo = moduleInfo
+        return rules
+
+    def invalidate(self):
+        self.lastModuleInfo = None
+
+    def close(self):
+        self.index.remove(self)
+        self.contextRules = {}
+        self.windows.clear()
+        self.lastModuleInfo = None
+
+    def getStats(self):
+        return dict(unchanged=self.unchanged, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, windows=len(self.windows))
@@ -128,6 +128,11 @@ try:
     import glob             # new way to collect the grammar files
     import pprint
     import natlinkstatus    # for extracting status info (QH)
+    import natlinktiming    # optional timing of the callbacks
+    import natlinktrace     # optional recording of the callbacks
+    import natlinkwatcher   # background checking of changed grammar files
+    import natlinkmanifest  # contents of the loaded grammar files
+    import gramcompiler     # compiling grammars in worker processes
     debugTiming=0
     #
     # This redirects stdout and stderr to a dialog box.
@@ -155,9 +160,43 @@ try:
     checkForGrammarChanges = 0
     
     def setCheckForGrammarChanges(value):
-        """switching on or off (1 or 0), for continuous checking or only a mic toggle"""
+        """switching on or off (1 or 0), for continuous checking or only a mic toggle
+
+        the file watcher (see below) runs only while this is on.
+        """
         global checkForGrammarChanges
         checkForGrammarChanges = value
+        if value:
+            if not fileWatcher:
+                startFileWatcher()
+        else:
+            stopFileWatcher()
+
+    # with checkForGrammarChanges on, the changed files are collected by a
+    # background thread (see natlinkwatcher.py), so beginCallback only has
+    # to reload these.  The thread is started by setCheckForGrammarChanges(1)
+    # (or by start_natlink if that was called before), and stopped by
+    # setCheckForGrammarChanges(0) and natDisconnect.  Set useFileWatcher to
+    # 0 to check all loaded files at each utterance instead.
+    useFileWatcher = 1
+    try:
+        fileWatcher
+    except NameError:
+        fileWatcher = None
+
+    def startFileWatcher():
+        """start watching the directories of searchImportDirs"""
+        global fileWatcher
+        stopFileWatcher()
+        if useFileWatcher and searchImportDirs:
+            fileWatcher = natlinkwatcher.FileWatcher(searchImportDirs)
+            fileWatcher.start()
+
+    def stopFileWatcher():
+        global fileWatcher
+        if fileWatcher:
+            fileWatcher.stop()
+            fileWatcher = None
     
     # start silent, set this to 0:
     natlinkmainPrintsAtEnd = 0
@@ -258,6 +297,20 @@ try:
     except NameError:
         lastModule = ''
     
+    #
+    # The size, time and contents hash of the file of each loaded module (see
+    # natlinkmanifest.py), a module is reloaded only if its contents changed.
+    # reloadCounts gives the number of reloads per module name.
+    #
+    try:
+        reloadManifest
+    except NameError:
+        reloadManifest = natlinkmanifest.ReloadManifest()
+    try:
+        reloadCounts
+    except NameError:
+        reloadCounts = {}
+
     # for information printing only
     try:
         changeCallbackUserFirst
@@ -298,8 +351,11 @@ try:
     
     def loadFile(modName, origName=None):
         global wrongFiles  # keep track of non edited files with errors
+        t0 = natlinktiming.timer()
         try: fndFile,fndName,fndDesc = imp.find_module(modName, searchImportDirs)
         except ImportError: return None     # module not found
+        # recorded below, only when the module is (re)loaded:
+        findSeconds = natlinktiming.timer() - t0
         if origName:
             if fndName[-3:] != ".py":
                 # not a Python source file
@@ -307,18 +363,19 @@ try:
                 safelyCall(modName,'unload')
                 return None
             if origName == fndName:
-                sourceDate = getFileDate(fndName)
-                objectDate = getFileDate(fndName+'c')
-                if objectDate >= sourceDate:    
-    ##                if debugLoad:
-    ##                    print 'not changed: %s (%s, %s)'% (fndName, sourceDate, objectDate)
+                if not reloadManifest.isChanged(fndName):
                     fndFile.close()
                     return origName
-            if debugLoad: print "Reloading", modName
+            reloadCounts[modName] = reloadCounts.get(modName, 0) + 1
+            if debugLoad:
+                print "Reloading %s (reload %s of this module, %s reloads in total)"% \
+                      (modName, reloadCounts[modName], sum(reloadCounts.values()))
     
             # if we know we are reloading a module, we call the unload function
             # in that module first to release all objects
+            t0 = natlinktiming.timer()
             safelyCall(modName,'unload')
+            natlinktiming.recordLoad(modName, 'unload', natlinktiming.timer() - t0)
         else:
             if fndName[-3:] != ".py":   
                 # not a Python source file
@@ -336,9 +393,23 @@ try:
                 print '-- skip unchanged wrong grammar file: %s'% fndName
                 return
     
+        # the time of the grammar loads and activations during the import
+        # is recorded by natlinkutils (see natlinktiming):
+        entry = natlinktiming.getLoadEntry(modName)
+        grammarTime = entry['grammars'] + entry['activate']
+        natlinktiming.recordLoad(modName, 'find', findSeconds)
+        natlinktiming.countLoad(modName, origName)
+        natlinktiming.loadingModule = modName
+        t0 = natlinktiming.timer()
         try:
-            imp.load_module(modName,fndFile,fndName,fndDesc)
+            try:
+                imp.load_module(modName,fndFile,fndName,fndDesc)
+            finally:
+                natlinktiming.loadingModule = None
+                grammarTime = entry['grammars'] + entry['activate'] - grammarTime
+                natlinktiming.recordLoad(modName, 'import', natlinktiming.timer() - t0 - grammarTime)
             fndFile.close()
+            reloadManifest.record(fndName)
             if fndName in wrongFiles:
                 del wrongFiles[fndName]  # release that 
             return fndName
@@ -396,36 +467,20 @@ try:
         if curModule:
             # special case, encountered with Vocola modules with . in name:
             moduleHasDot = curModule.find(".") >= 0
-            curModuleEscaped = re.escape(curModule)
-            pat = re.compile(r"""
-                ^(%s        # filename must match module name
-    ##            (_\w+)?)    # optional underscore followed by text (old)
-                (_.*)?)    # optional underscore followed by anything (or nothing) (QH)
-                [.]py$      # extension .py
-              """%curModuleEscaped, re.VERBOSE|re.IGNORECASE)
-        else:
-            pat = re.compile(r"""
-                ^(_         # filename must start with an underscore
-    ##            \w+)        # remainder of filename (old)
-                 .+)        # remainder of filename (anything) (QH)
-                [.]py$      # extension .py
-              """, re.VERBOSE|re.IGNORECASE)
     
         filesToLoad = {}
         if userDirectory != '':
-            userDirFiles = [x for x in os.listdir(userDirectory) if x.endswith('.py')]
-            for x in userDirFiles:
-                res = pat.match(x)
-                if res: addToFilesToLoad( filesToLoad, res.group(1), userDirectory, moduleHasDot )
+            for x in getGrammarFiles(userDirectory, curModule):
+                addToFilesToLoad( filesToLoad, x, userDirectory, moduleHasDot )
         # baseDirectory:
         if baseDirectory:
-            baseDirFiles = [x for x in os.listdir(baseDirectory) if x.endswith('.py')]
+            baseDirFiles = getDirectoryListing(baseDirectory)[2]
         else:
-            baseDirFiles = []
+            baseDirFiles = ()
     
         # if present, load _vocola_main first, it can generate grammar files
         # before proceeding:
-        vocolaEnabled = (vocolaEnabled and doVocolaFirst and doVocolaFirst+'.py' in baseDirFiles)
+        vocolaEnabled = (vocolaEnabled and doVocolaFirst and doVocolaFirst in baseDirFiles)
         if debugLoad:
             print 'vocolaEnabled: %s'% vocolaEnabled
         if vocolaEnabled and not vocolaIsLoaded:
@@ -444,11 +499,12 @@ try:
                         vocolaEnabled = 0
                         del loadedFiles[x]
                         if debugLoad: print 'Vocola is disabled...'
-            # repeat the base directory, as Vocola just had the chance to rebuild Python grammar files:
-            baseDirFiles = [x for x in os.listdir(baseDirectory) if x.endswith('.py')]
-        for x in baseDirFiles:
-            res = pat.match(x)
-            if res: addToFilesToLoad( filesToLoad, res.group(1), baseDirectory, moduleHasDot )
+            # the base directory is listed again if Vocola changed it (see
+            # getDirectoryListing), as Vocola just had the chance to rebuild
+            # Python grammar files
+        if baseDirectory:
+            for x in getGrammarFiles(baseDirectory, curModule):
+                addToFilesToLoad( filesToLoad, x, baseDirectory, moduleHasDot )
     
         # Try to (re)load any files we find
         # to Unimacro grammar control last:
@@ -457,18 +513,122 @@ try:
         # user wishes?? _control last, _tasks first for Unimacro
         keysToLoad = reorderKeys(filesToLoad.keys())
         if debugLoad: print 'filesToLoad: %s'% keysToLoad
-        
-        for x in keysToLoad:
-            if x == doVocolaFirst:
-                continue
-            origName = loadedFiles.get(x, None)
-            loadedFiles[x] = loadFile(x, origName)
+        preparer = startGrammarPreparer(keysToLoad)
+        try:
+            for x in keysToLoad:
+                if x == doVocolaFirst:
+                    continue
+                origName = loadedFiles.get(x, None)
+                if preparer:
+                    preparer.waitFor(x)
+                loadedFiles[x] = loadFile(x, origName)
+        finally:
+            if preparer:
+                if debugLoad:
+                    print 'grammars prepared in worker processes: %s'% preparer.getStats()
+                preparer.close()
     
         # Unload any files which have been deleted
         for name, path in loadedFiles.items():
-            if path and not getFileDate(path):
+            if path and not isListedFile(path):
                 safelyCall(name,'unload')
                 del loadedFiles[name]
+                reloadManifest.forget(path)
+        reloadManifest.save()
+
+    #
+    # When prepareGrammarsMinimum is set (eg 4) and at least that number of
+    # new modules have grammars that are not in the grammar cache (at the
+    # start, or after a user change), the grammars of these modules are
+    # compiled into the cache in worker processes while the modules are
+    # imported one by one (see GrammarPreparer in gramcompiler.py).  It is
+    # off (0) by default.
+    #
+    prepareGrammarsMinimum = 0
+
+    def startGrammarPreparer(keysToLoad):
+        """return a GrammarPreparer for the modules of keysToLoad that are not loaded, or None"""
+        if not prepareGrammarsMinimum:
+            return None
+        import natlinkutils  # imported by the grammars anyway
+        cache = natlinkutils.grammarCache
+        if not cache:
+            return None
+        modules = []
+        for x in keysToLoad:
+            if x == doVocolaFirst or loadedFiles.get(x):
+                continue
+            path = findGrammarFile(x)
+            if path and gramcompiler.getMissingGramSpecs(path, cache):
+                modules.append( (x, path) )
+        if len(modules) < prepareGrammarsMinimum:
+            return None
+        return gramcompiler.GrammarPreparer(modules, cache)
+
+    def findGrammarFile(modName):
+        """path of the python file of modName in searchImportDirs, from the listings"""
+        for directory in searchImportDirs:
+            if modName in getDirectoryListing(directory)[2]:
+                return os.path.join(directory, modName + '.py')
+
+    #
+    # The python files of the grammar directories are listed once, and listed
+    # again only when the modification time of the directory changes (files
+    # added, removed or renamed).  For each directory an index is kept of:
+    #
+    #   - the global files: names starting with an underscore ("_macro.py")
+    #   - the module specific files by module name in lower case: the file
+    #     name is the module name, optionally followed by an underscore and
+    #     anything ("wordpad.py", "wordpad_extra.py"), not case sensitive.
+    #
+    # So switching to another program is a dict lookup (after one os.stat of
+    # each directory).  A directory modified within the last listingMinAge
+    # seconds is listed again every time, because of the coarse time
+    # stamps of some file systems.
+    #
+    try:
+        directoryListings
+    except NameError:
+        directoryListings = {}  # directory: (mtime, listing)
+    listingMinAge = 2
+
+    def getDirectoryListing(directory):
+        """return (globalFiles, filesByModule, allFiles) of directory
+
+        the names are without .py, allFiles is a set
+        """
+        try:
+            mtime = os.stat(directory)[ST_MTIME]
+        except OSError:
+            return [], {}, set()
+        cached = directoryListings.get(directory)
+        if cached and cached[0] == mtime and time.time() - mtime > listingMinAge:
+            return cached[1]
+        names = sorted([x[:-3] for x in os.listdir(directory) if x.endswith('.py')])
+        globalFiles = [x for x in names if x.startswith('_') and len(x) > 1]
+        filesByModule = {}
+        for x in names:
+            lower = x.lower()
+            filesByModule.setdefault(lower, []).append(x)
+            i = lower.find('_', 1)
+            while i > 0:
+                filesByModule.setdefault(lower[:i], []).append(x)
+                i = lower.find('_', i+1)
+        listing = globalFiles, filesByModule, set(names)
+        directoryListings[directory] = (mtime, listing)
+        return listing
+
+    def getGrammarFiles(directory, curModule=None):
+        """the global files (no curModule) or the files of program curModule"""
+        globalFiles, filesByModule, allFiles = getDirectoryListing(directory)
+        if curModule:
+            return filesByModule.get(curModule.lower(), [])
+        return globalFiles
+
+    def isListedFile(path):
+        """test if the python file path (still) exists, from the listing of its directory"""
+        directory, name = os.path.split(path)
+        return name[:-3] in getDirectoryListing(directory)[2]
     
     def reorderKeys(modulesKeys):
         """here is the chance to influence the order of loading
@@ -596,9 +756,19 @@ try:
         if natlink.getCallbackDepth() > 1:
             return
         t0 = time.time()
+        if natlinktrace.recorder:
+            natlinktrace.record(natlinktrace.BEGIN, 'natlinkmain', moduleInfo)
         
         if vocolaEnabled and vocolaIsLoaded:
+            t1 = natlinktiming.timer()
             result = vocolaModule.vocolaBeginCallback(moduleInfo)
+            vocolaSeconds = natlinktiming.timer() - t1
+            # only the calls that made or changed grammar modules count as
+            # loading time, all calls are in the callback timing:
+            if result in (1, 2):
+                natlinktiming.recordLoad(doVocolaFirst, 'vocola', vocolaSeconds)
+            if natlinktiming.enabled:
+                natlinktiming.record('natlinkmain', 'vocolaBeginCallback', vocolaSeconds)
             if result == 2:
                 if debugCallback:
                     print 'Vocola made new module, load all Python files'
@@ -612,9 +782,19 @@ try:
                 if debugCallback:
                     print 'no changes Vocola user files'
                     
-        if checkAll or checkForGrammarChanges:
+        if checkForGrammarChanges and not checkAll and fileWatcher and fileWatcher.isCurrent():
+            # only the files changed since the previous utterance:
+            if fileWatcher.dirty:
+                if debugCallback:
+                    print 'check for changed files (from the file watcher)...'
+                reloadChangedFiles(fileWatcher.takeChanges(), moduleInfo)
+            else:
+                loadModSpecific(moduleInfo, 1)  # only if changed module
+        elif checkAll or checkForGrammarChanges:
             if debugCallback:
                 print 'check for changed files (all files)...'
+            if fileWatcher:
+                fileWatcher.takeChanges()  # all files are checked now
             for x in loadedFiles.keys():
                 loadedFiles[x] = loadFile(x, loadedFiles[x])
             loadModSpecific(moduleInfo)  # in checkAll or checkForGrammarChanges mode each time
@@ -622,9 +802,31 @@ try:
             if debugCallback:
                 print 'check for changed files (only specific)'
             loadModSpecific(moduleInfo, 1)  # only if changed module
+        if reloadManifest.dirty:
+            reloadManifest.save()
         if debugTiming:
             print 'checked all grammar files: %.6f'% (time.time()-t0,)
+        if natlinktiming.enabled:
+            natlinktiming.record('natlinkmain', 'beginCallback', time.time()-t0)
             
+    def reloadChangedFiles(changed, moduleInfo):
+        """reload the loaded modules whose file is in changed (a set of normPath's)
+
+        if other files were changed (new or removed files, or files that could
+        not be loaded), the directories are searched again.
+        """
+        global loadedFiles
+        nReloaded = 0
+        for x, path in loadedFiles.items():
+            if path and natlinkwatcher.normPath(path) in changed:
+                loadedFiles[x] = loadFile(x, path)
+                nReloaded += 1
+        if nReloaded < len(changed):
+            findAndLoadFiles()
+            loadModSpecific(moduleInfo)
+        else:
+            loadModSpecific(moduleInfo, 1)
+
     #
     # This callback is called when the user changes or when the microphone
     # changes state.  We check for changes when the microphone is turned on.
@@ -635,6 +837,9 @@ try:
     
     def changeCallback(type,args):
         global userName, DNSuserDirectory, language, BaseModel, BaseTopic, DNSmode, changeCallbackUserFirst
+        t0 = time.time()
+        if natlinktrace.recorder:
+            natlinktrace.record(natlinktrace.CHANGE, 'natlinkmain', (type, args))
         if debugCallback:
             print 'changeCallback, type: %s, args: %s'% (type, args)
         if type == 'mic' and args == 'on':
@@ -683,6 +888,8 @@ try:
         # and the grammar should have a cancelMode function that finishes exclusive mode.
         # see _oops, _repeat, _control for examples
         changeCallbackLoadedModules(type,args)
+        if natlinktiming.enabled:
+            natlinktiming.record('natlinkmain', 'changeCallback', time.time()-t0)
     ##    else:
     ##        # possibility to do things when changeCallBack with mic on: (experiment)
     ##        changeCallbackLoadedModulesMicOn(type, args)
@@ -701,7 +908,10 @@ try:
                 except AttributeError: pass
                 else:
     ##                print 'call changeCallback for: %s'% x
-                    apply(func, [type,args])
+                    if natlinktiming.enabled:
+                        natlinktiming.timeCall(x, 'changeCallback', func, [type,args])
+                    else:
+                        apply(func, [type,args])
     
     ### try here a adapted recognitionMimic function
     def recognitionMimic(mimicList):
@@ -717,6 +927,7 @@ try:
         """do the startup of the python macros system
         """
         global userDirectory, DNSVersion, baseDirectory, WindowsVersion
+        startTime = natlinktiming.timer()
         try:
             # compute the directory where this module came from
             if not natlink.isNatSpeakRunning():
@@ -752,6 +963,8 @@ try:
         
             # setting searchImportDirs:
             setSearchImportDirs()
+            if checkForGrammarChanges:
+                startFileWatcher()
         
             # get invariant variables:
             DNSVersion = status.getDNSVersion()
@@ -772,6 +985,9 @@ try:
             print 'natlinkmain started from %s:\n  NatLink version: %s\n  DNS version: %s\n  Python version: %s\n  Windows Version: %s\n'% \
                       (status.getCoreDirectory(), status.getInstallVersion(),
                        DNSVersion, status.getPythonVersion(), WindowsVersion)
+            natlinktiming.setStartupSeconds(natlinktiming.timer() - startTime)
+            if debugLoad:
+                natlinktiming.printLoadReport()
 
         
         except:
@@ -793,6 +1009,7 @@ try:
     
     # try to establish here only one automatic startup of start_natlink:
     def natDisconnect():
+        stopFileWatcher()
         natlink.natDisconnect()
         if debugLoad:
             print 'after natDisconnect'
@@ -0,0 +1,142 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# natlinkmanifest.py
+#   This module keeps the reload manifest of natlinkmain: for each loaded
+#   grammar module the size, the modification time and a hash of the
+#   contents of its python file.  natlinkmain.loadFile reloads a module only
+#   when the contents changed, instead of comparing the dates of the .py and
+#   the .pyc file (a missing or old .pyc, or a clock difference on a synced
+#   directory, does not cause a reload then, or miss one).
+#
+#   manifest = ReloadManifest(filename=None)
+#       filename default "reloadmanifest" in the folder grammarcache next to
+#       this module (the folder of gramcache).
+#
+#   manifest.isChanged(path)
+#       True if the contents of the file differ from the recorded ones (or
+#       nothing was recorded).  The file is only hashed when its size or
+#       modification time changed; if the hash is the same, the new size and
+#       time are recorded, so the file is not hashed again.
+#
+#   manifest.record(path)
+#       Record the file as it is now (after (re)loading the module).
+#
+#   manifest.save()
+#       Write the manifest if it changed.
+#
+# The counters unchanged, hashed, changed and errors can be inspected with
+# getStats().  Errors reading or writing the manifest are never fatal.
+#
+import os, os.path
+import cPickle as pickle
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+manifestVersion = 1
+
+class ReloadManifest(object):
+    """(size, mtime, hash) of the python files of the loaded grammar modules
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'grammarcache', 'reloadmanifest')
+        self.filename = filename
+        self.entries = None  # path: (size, mtime, hash), read on first use
+        self.dirty = 0
+        self.unchanged = self.hashed = self.changed = self.errors = 0
+
+    def getEntries(self):
+        if self.entries is None:
+            self.entries = {}
+            try:
+                f = open(self.filename, 'rb')
+                try:
+                    version, entries = pickle.load(f)
+                finally:
+                    f.close()
+                if version == manifestVersion:
+                    self.entries = entries
+            except (IOError, OSError, EOFError, ValueError, TypeError,
+                    pickle.UnpicklingError):
+                pass
+        return self.entries
+
+    def getHash(self, path):
+        f = open(path, 'rb')
+        try:
+            return sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+
+    def isChanged(self, path):
+        entries = self.getEntries()
+        entry = entries.get(path)
+        try:
+            st = os.stat(path)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+                self.unchanged += 1
+                return 0
+            if not entry:
+                self.changed += 1
+                return 1
+            self.hashed += 1
+            digest = self.getHash(path)
+        except (IOError, OSError):
+            self.errors += 1
+            return 1
+        if digest == entry[2]:
+            # only the time stamp changed
+            entries[path] = (st.st_size, st.st_mtime, digest)
+            self.dirty = 1
+            self.unchanged += 1
+            return 0
+        self.changed += 1
+        return 1
+
+    def record(self, path):
+        entries = self.getEntries()
+        try:
+            st = os.stat(path)
+            entry = (st.st_size, st.st_mtime, self.getHash(path))
+        except (IOError, OSError):
+            self.errors += 1
+            return
+        if entries.get(path) != entry:
+            entries[path] = entry
+            self.dirty = 1
+
+    def forget(self, path):
+        if path in self.getEntries():
+            del self.entries[path]
+            self.dirty = 1
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmpPath = '%s.%s.tmp'% (self.filename, os.getpid())
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(tmpPath, 'wb')
+            try:
+                pickle.dump((manifestVersion, self.entries), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.path.isfile(self.filename):
+                os.remove(self.filename)
+            os.rename(tmpPath, self.filename)
+        except (IOError, OSError):
+            self.errors += 1
+            try: os.remove(tmpPath)
+            except OSError: pass
+            return
+        self.dirty = 0
+
+    def getStats(self):
+        return dict(entries=len(self.getEntries()), unchanged=self.unchanged,
+                    hashed=self.hashed, changed=self.changed, errors=self.errors)
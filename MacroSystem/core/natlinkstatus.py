@@ -145,11 +145,17 @@ getDNSName: return "NatSpeak" for versions <= 11 and "Dragon" for 12 (on)
 getAhkExeDir: return the directory where AutoHotkey is found (only needed when not in default)
 getAhkUserDir: return User Directory of AutoHotkey, not needed when it is in default.
 
+getLoadTimingReport(maxLines=20): the time spent loading the grammar modules
+    (find, import, grammar load and activation, unload) and Vocola, slowest
+    modules first, and the startup time of natlinkmain (see natlinktiming).
+printLoadTimingReport(maxLines=20): print this report.
+
 """
 
 
 import os, re, win32api, win32con, sys, pprint, stat
 import RegistryDict, natlinkcorefunctions
+import natlinktiming
 import pywintypes
 # for getting generalised env variables:
 
@@ -1203,6 +1209,13 @@ Please try to correct this by running the NatLink Config Program (with administr
         else:
             return "Dragon"
 
+    def getLoadTimingReport(self, maxLines=20):
+        """the timing of loading the grammar modules, slowest first (natlinktiming)"""
+        return natlinktiming.getLoadReport(maxLines)
+
+    def printLoadTimingReport(self, maxLines=20):
+        print self.getLoadTimingReport(maxLines)
+
     def getNatlinkStatusDict(self):
         """return actual status in a dict"""
         D = {}
@@ -0,0 +1,229 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# natlinktiming.py
+#   This module records how long the callbacks of the grammars take
+#   (gotBegin, gotResultsInit, gotResults_xxx, gotResults, ...), and the
+#   begin and change callbacks of natlinkmain, in order to find the slow
+#   ones.  The timing is off by default, and costs nothing then.
+#
+#   enable() / disable()
+#       Switch the timing on or off.  natlinkutils then times the callbacks
+#       of all grammars (also the grammars that are already loaded).
+#
+#   reset()
+#       Remove all recorded data.
+#
+#   getSnapshot()
+#       Returns a dict {grammarName: {handlerName: info}}, info being a dict
+#       with count, total, mean and max (in milliseconds), p50 and p95 (the
+#       upper bound of the histogram bucket, at most max) and buckets
+#       (the counts per bucket, see bucketBounds).
+#
+#   getReport(maxLines=None)
+#       The same as a text table, the handlers with the largest total time
+#       first.  writeReport(filename) writes this report to a file.  The
+#       control grammar MacroSystem/_natlinktiming.py has the commands
+#       "natlink timing (on | off | report | reset)" for these functions.
+#
+# The durations are wall clock times, kept per (grammarName, handlerName)
+# in a histogram with fixed buckets, so the memory used does not grow with
+# the number of calls.  The grammar name is "module.ClassName" of the
+# grammar object.
+#
+# The loading of the grammar modules by natlinkmain is always timed (this
+# costs nothing during recognition).  Per module name, in seconds:
+#
+#   find        imp.find_module (only when the module is loaded or
+#               reloaded, not for the checks of unchanged modules)
+#   import      imp.load_module, without the grammar load and activation
+#   grammars    GrammarBase.load while the module was imported
+#   activate    the activate functions of GrammarBase while the module was
+#               imported
+#   unload      the unload function of the module, before reloading
+#   vocola      vocolaBeginCallback (for the Vocola module), only the calls
+#               that made or changed grammar modules.  With the callback
+#               timing on, every call is also recorded as handler
+#               vocolaBeginCallback of 'natlinkmain'.
+#
+# and the number of loads and reloads.  startupSeconds is the duration of
+# natlinkmain.start_natlink.
+#
+#   getLoadSnapshot()
+#       {modName: {phase: seconds, 'loads': n, 'reloads': n}}
+#
+#   getLoadReport(maxLines=20)
+#       The slowest modules as a text table (also with
+#       natlinkstatus.NatlinkStatus().getLoadTimingReport()).
+#       printLoadReport(maxLines=20) prints it.
+#
+import bisect
+from timeit import default_timer as timer
+
+# upper bounds of the histogram buckets in milliseconds, the last bucket
+# counts the longer durations:
+bucketBounds = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+enabled = 0
+
+# (grammarName, handlerName): Histogram
+histograms = {}
+
+# functions that are called with 1 or 0 when the timing is switched on or
+# off (natlinkutils registers itself here):
+switchCallbacks = []
+
+# the timing of loading the grammar modules (see top of module):
+loadPhases = ('find', 'import', 'grammars', 'activate', 'unload', 'vocola')
+loadTimes = {}  # modName: {phase: seconds, 'loads': n, 'reloads': n}
+startupSeconds = None
+# the name of the module that natlinkmain is importing, else None:
+loadingModule = None
+
+class Histogram(object):
+    """counts of the durations of one handler, per bucket"""
+    __slots__ = ('counts', 'count', 'total', 'maximum')
+
+    def __init__(self):
+        self.counts = [0] * (len(bucketBounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(bucketBounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.maximum:
+            self.maximum = ms
+
+    def percentile(self, p):
+        """upper bound of the bucket that contains percentile p (0-100)"""
+        if not self.count:
+            return 0.0
+        limit = self.count * p / 100.0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= limit and c:
+                if i < len(bucketBounds):
+                    return min(float(bucketBounds[i]), self.maximum)
+                return self.maximum
+        return self.maximum
+
+    def getInfo(self):
+        return dict(count=self.count, total=self.total,
+                    mean=self.count and self.total/self.count or 0.0,
+                    max=self.maximum, p50=self.percentile(50),
+                    p95=self.percentile(95), buckets=list(self.counts))
+
+def record(grammarName, handlerName, seconds):
+    key = grammarName, handlerName
+    try:
+        histogram = histograms[key]
+    except KeyError:
+        histogram = histograms[key] = Histogram()
+    histogram.add(seconds * 1000.0)
+
+def timeCall(grammarName, handlerName, func, argList):
+    """call func with argList and record the duration"""
+    t0 = timer()
+    try:
+        return func(*argList)
+    finally:
+        record(grammarName, handlerName, timer() - t0)
+
+def wrapHandler(grammarName, handlerName, func):
+    """return a function that calls func and records the duration"""
+    def timedHandler(*args):
+        t0 = timer()
+        try:
+            return func(*args)
+        finally:
+            record(grammarName, handlerName, timer() - t0)
+    return timedHandler
+
+def enable():
+    setEnabled(1)
+
+def disable():
+    setEnabled(0)
+
+def setEnabled(value):
+    global enabled
+    enabled = value and 1 or 0
+    for func in switchCallbacks:
+        func(enabled)
+
+def reset():
+    histograms.clear()
+
+def getSnapshot():
+    snapshot = {}
+    for (grammarName, handlerName), histogram in histograms.items():
+        snapshot.setdefault(grammarName, {})[handlerName] = histogram.getInfo()
+    return snapshot
+
+def getReport(maxLines=None):
+    lines = []
+    items = sorted(histograms.items(), key=lambda item: -item[1].total)
+    lines.append('%-40s %-28s %7s %10s %8s %8s %8s %8s'% \
+                 ('grammar', 'handler', 'count', 'total ms', 'mean', 'p50', 'p95', 'max'))
+    for (grammarName, handlerName), h in items[:maxLines]:
+        info = h.getInfo()
+        lines.append('%-40s %-28s %7s %10.1f %8.2f %8.1f %8.1f %8.1f'% \
+                     (grammarName, handlerName, info['count'], info['total'], info['mean'],
+                      info['p50'], info['p95'], info['max']))
+    if not items:
+        lines.append('(no callbacks recorded%s)'% (not enabled and ', timing is off' or ''))
+    return '\n'.join(lines)
+
+def writeReport(filename, maxLines=None):
+    f = open(filename, 'w')
+    f.write(getReport(maxLines))
+    f.write('\n')
+    f.close()
+
+def getLoadEntry(modName):
+    try:
+        return loadTimes[modName]
+    except KeyError:
+        entry = loadTimes[modName] = dict([(phase, 0.0) for phase in loadPhases])
+        entry['loads'] = entry['reloads'] = 0
+        return entry
+
+def recordLoad(modName, phase, seconds):
+    getLoadEntry(modName)[phase] += seconds
+
+def countLoad(modName, reload=0):
+    getLoadEntry(modName)[reload and 'reloads' or 'loads'] += 1
+
+def setStartupSeconds(seconds):
+    global startupSeconds
+    startupSeconds = seconds
+
+def getLoadSnapshot():
+    return dict([(modName, dict(entry)) for modName, entry in loadTimes.items()])
+
+def getLoadReport(maxLines=20):
+    lines = []
+    if startupSeconds is not None:
+        lines.append('natlinkmain startup: %.3f s'% startupSeconds)
+    totals = [(sum([entry[phase] for phase in loadPhases]), modName, entry)
+              for modName, entry in loadTimes.items()]
+    totals.sort(reverse=True)
+    lines.append('%-30s %8s %8s %8s %8s %8s %8s %8s %5s %7s'% \
+                 (('module', 'total ms') + tuple(loadPhases) + ('loads', 'reloads')))
+    for total, modName, entry in totals[:maxLines]:
+        lines.append('%-30s %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %8.1f %5s %7s'% \
+                     ((modName, total*1000) + tuple([entry[phase]*1000 for phase in loadPhases]) +
+                      (entry['loads'], entry['reloads'])))
+    if not totals:
+        lines.append('(no modules loaded)')
+    elif len(totals) > maxLines:
+        lines.append('(%s more modules, %.1f ms)'% (len(totals) - maxLines,
+                                                   sum([t[0] for t in totals[maxLines:]])*1000))
+    return '\n'.join(lines)
+
+def printLoadReport(maxLines=20):
+    print getLoadReport(maxLines)
@@ -0,0 +1,284 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# natlinktrace.py
+#   This module records the callbacks of natlink (begin, change, results and
+#   hypotheses) in a trace file, and plays a trace back through the python
+#   callbacks of the grammars and natlinkmain, for benchmarks and regression
+#   tests with real traffic.  The recording is off by default.
+#
+#   start(filename, maxBytes=10MB) / stop()
+#       Switch the recording on or off.  While on, natlinkmain records the
+#       begin callback (moduleInfo) and the change callback (type, args), and
+#       the grammars (GramClassBase) record their results (wordsAndNums, or
+#       the recognition type 'other' or 'reject') and their hypotheses.  The
+#       grammar name is getReportName() of the grammar ("module.ClassName").
+#
+#   readTrace(filename)
+#       Yields the events of a trace file as (eventType, timestamp, name,
+#       data) tuples, eventType being one of BEGIN, CHANGE, RESULTS and
+#       HYPOTHESIS.
+#
+#   replayTrace(filename, grammars=(), main=None, pacing=0)
+#       Feeds the events of a trace back through the callbacks: BEGIN to
+#       main.beginCallback (main being natlinkmain or None) and to the
+#       beginCallback of all grammars, CHANGE to main.changeCallback,
+#       RESULTS and HYPOTHESIS to resultsCallback and hypothesisCallback of
+#       the grammar with that name (grammars is a list of loaded grammar
+#       objects).  pacing 0 replays at full speed, 1 at the recorded pace,
+#       2 twice as fast etc.  Returns a dict with the numbers of events,
+#       the elapsed time, the events per second and the latency
+#       distribution per event type (see natlinktiming.Histogram).
+#       formatReplay(result) gives the report as text.
+#
+#   installStandIn()
+#       Puts a stand-in natlink module in sys.modules, for replaying without
+#       Dragon (eg on Linux).  It must be called before natlinkutils is
+#       imported.  Its GramObj does nothing, the other natlink functions do
+#       nothing and return None.  When the keystroke modules of natlinkutils
+#       (ExtendedSendDragonKeys and SendInput, which need win32con and the
+#       Windows dlls) cannot be imported, stand-ins for these are put in
+#       sys.modules too, which send no keystrokes.
+#
+# The trace file is append only.  Each event is a header (struct
+# recordHeader: event type, timestamp, length) followed by the marshalled
+# (name, data).  When the file would grow over maxBytes it is renamed to
+# filename + '.1' (replacing an older one) and a new file is started, so at
+# most twice maxBytes is kept.  readTrace(filename) does not read the .1
+# file, pass it separately if needed.
+#
+import os, os.path, sys, struct, marshal, time, types, traceback
+from timeit import default_timer as timer
+import natlinktiming
+
+BEGIN, CHANGE, RESULTS, HYPOTHESIS = 1, 2, 3, 4
+eventNames = {BEGIN: 'begin', CHANGE: 'change', RESULTS: 'results',
+              HYPOTHESIS: 'hypothesis'}
+
+fileHeader = 'NLTRACE1'
+recordHeader = struct.Struct('<BdI')
+
+# the active TraceRecorder, None when not recording:
+recorder = None
+
+class TraceRecorder(object):
+    """appends events to a trace file of bounded size"""
+    def __init__(self, filename, maxBytes=10*1024*1024):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.events = self.rotations = 0
+        self.open()
+
+    def open(self):
+        self.file = open(self.filename, 'ab')
+        self.size = self.file.tell()
+        if not self.size:
+            self.file.write(fileHeader)
+            self.size = len(fileHeader)
+
+    def write(self, eventType, name, data):
+        payload = marshal.dumps((name, data))
+        record = recordHeader.pack(eventType, time.time(), len(payload)) + payload
+        if self.size + len(record) > self.maxBytes and self.size > len(fileHeader):
+            self.rotate()
+        self.file.write(record)
+        self.size += len(record)
+        self.events += 1
+
+    def rotate(self):
+        self.file.close()
+        oldName = self.filename + '.1'
+        if os.path.isfile(oldName):
+            os.remove(oldName)
+        os.rename(self.filename, oldName)
+        self.rotations += 1
+        self.open()
+
+    def close(self):
+        self.file.close()
+
+def start(filename, maxBytes=10*1024*1024):
+    global recorder
+    stop()
+    recorder = TraceRecorder(filename, maxBytes)
+
+def stop():
+    global recorder
+    if recorder:
+        recorder.close()
+        recorder = None
+
+def record(eventType, name, data):
+    """called by natlinkmain and natlinkutils, only when recording"""
+    if recorder:
+        try:
+            recorder.write(eventType, name, data)
+        except (IOError, OSError, ValueError):
+            # a trace must never break the callbacks
+            print 'natlinktrace, recording stopped: %s'% sys.exc_info()[1]
+            stop()
+
+def readTrace(filename):
+    f = open(filename, 'rb')
+    try:
+        if f.read(len(fileHeader)) != fileHeader:
+            raise ValueError('not a natlink trace file: %s'% filename)
+        headerSize = recordHeader.size
+        while 1:
+            header = f.read(headerSize)
+            if len(header) < headerSize:
+                break
+            eventType, timestamp, length = recordHeader.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break  # the last event was not written completely
+            name, data = marshal.loads(payload)
+            yield eventType, timestamp, name, data
+    finally:
+        f.close()
+
+#---------------------------------------------------------------------------
+# replay
+
+class StandInResObj(object):
+    """results object passed to resultsCallback during a replay"""
+    def getWords(self, choice):
+        return []
+    def getResults(self, choice):
+        return []
+    def getSelectInfo(self, gramObj, choice):
+        return 0, 0
+    def getWave(self):
+        return ''
+    def correction(self, words):
+        return 0
+
+def replayTrace(filename, grammars=(), main=None, pacing=0):
+    byName = {}
+    for grammar in grammars:
+        byName[grammar.getReportName()] = grammar
+    histograms = dict([(eventType, natlinktiming.Histogram()) for eventType in eventNames])
+    counts = dict(events=0, skipped=0, errors=0)
+    resObj = StandInResObj()
+    firstTimestamp = startTime = None
+    replayStart = timer()
+    for eventType, timestamp, name, data in readTrace(filename):
+        if firstTimestamp is None:
+            firstTimestamp, startTime = timestamp, timer()
+        if pacing:
+            delay = (timestamp - firstTimestamp)/pacing - (timer() - startTime)
+            if delay > 0:
+                time.sleep(delay)
+        if eventType == BEGIN:
+            calls = [(grammar.beginCallback, (data,)) for grammar in grammars]
+            if main:
+                calls.insert(0, (main.beginCallback, (data,)))
+        elif eventType == CHANGE:
+            calls = main and [(main.changeCallback, tuple(data))] or []
+        elif name in byName and eventType == RESULTS:
+            calls = [(byName[name].resultsCallback, (data, resObj))]
+        elif name in byName and eventType == HYPOTHESIS:
+            calls = [(byName[name].hypothesisCallback, (data,))]
+        else:
+            calls = []
+        if not calls:
+            counts['skipped'] += 1
+            continue
+        t0 = timer()
+        for func, args in calls:
+            try:
+                func(*args)
+            except Exception:
+                if not counts['errors']:
+                    traceback.print_exc()
+                counts['errors'] += 1
+        histograms[eventType].add((timer() - t0) * 1000.0)
+        counts['events'] += 1
+    elapsed = timer() - replayStart
+    result = dict(counts, elapsed=elapsed,
+                  eventsPerSecond=elapsed and counts['events']/elapsed or 0.0,
+                  latency=dict([(eventNames[eventType], h.getInfo())
+                                for eventType, h in histograms.items() if h.count]))
+    return result
+
+def formatReplay(result):
+    lines = ['%(events)s events in %(elapsed).3f s, %(eventsPerSecond).0f events/s, '
+             '%(skipped)s skipped, %(errors)s errors'% result]
+    lines.append('%-12s %7s %8s %8s %8s %8s'% ('event', 'count', 'mean ms', 'p50', 'p95', 'max'))
+    for name, info in sorted(result['latency'].items()):
+        lines.append('%-12s %7s %8.3f %8.2f %8.2f %8.2f'% \
+                     (name, info['count'], info['mean'], info['p50'], info['p95'], info['max']))
+    return '\n'.join(lines)
+
+#---------------------------------------------------------------------------
+# stand-in natlink module
+
+class StandInError(Exception):
+    pass
+
+class StandInGramObj(object):
+    """GramObj that keeps the callbacks and does nothing else"""
+    def __init__(self):
+        self.beginCallback = self.resultsCallback = self.hypothesisCallback = None
+    def setBeginCallback(self, func):
+        self.beginCallback = func
+    def setResultsCallback(self, func):
+        self.resultsCallback = func
+    def setHypothesisCallback(self, func):
+        self.hypothesisCallback = func
+    def getSelectText(self):
+        return ''
+    def __getattr__(self, name):
+        # load, unload, activate, deactivate, setExclusive, emptyList,
+        # appendList, setContext, setSelectText...
+        return lambda *args, **kw: None
+
+class StandInNatlink(types.ModuleType):
+    """the natlink functions used by natlinkmain and the grammars"""
+    BadGrammar = BadWindow = InvalidWord = UnknownName = OutOfRange = \
+                 WrongState = WrongType = NatError = SyntaxError = DataMissing = StandInError
+    GramObj = StandInGramObj
+
+    def __init__(self):
+        types.ModuleType.__init__(self, 'natlink')
+        self.currentModule = ('', '', 0)
+
+    def getCallbackDepth(self):
+        return 1
+
+    def getCurrentModule(self):
+        return self.currentModule
+
+    def isNatSpeakRunning(self):
+        return 0
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kw: None
+
+def standInSendKeys(*args, **kw):
+    return []
+
+# the functions natlinkutils imports from the keystroke modules:
+standInKeyModules = {
+    'SendInput': {'send_input': standInSendKeys},
+    'ExtendedSendDragonKeys': {'senddragonkeys_to_events': standInSendKeys},
+    }
+
+def installStandIn():
+    """put a StandInNatlink in sys.modules as natlink, return it
+
+    stand-ins for the keystroke modules are installed when these cannot be
+    imported (on other systems than Windows).
+    """
+    standIn = StandInNatlink()
+    sys.modules['natlink'] = standIn
+    for modName, functions in standInKeyModules.items():
+        try:
+            __import__(modName)
+        except Exception:
+            module = types.ModuleType(modName)
+            module.__dict__.update(functions)
+            sys.modules[modName] = module
+    return standIn
@@ -50,6 +50,25 @@
 #       specified module name and window title.  Returns window handle on
 #       match and None on mismatch. Note that moduleInfo may be ("","",0)
 #       which we should handle cleanly.
+#       For activating rules per window in gotBegin, see the
+#       ActivationManager in natlinkcontext.py, for matching the patterns of
+#       many grammars in one pass see windowIndex in the same module.
+#
+#   grammarCache
+#       The cache of compiled grammars (see gramcache.py), which is used by
+#       GrammarBase.load.  Set to None in order to parse and pack each grammar
+#       at every load.
+#
+#   loadedGrammars
+#       A WeakSet of the GrammarBase instances that are loaded.
+#
+#   setCallbackTiming(enabled)
+#       Called by natlinktiming.enable() and disable(), in order to record
+#       the duration of the callbacks of all grammars (see natlinktiming.py).
+#
+#   getMemoryReport()
+#       Returns a list of (bytes, grammarName) for the loaded grammars,
+#       largest first.
 #
 #   See also the constants at the top of this file.
 
@@ -62,13 +81,37 @@ if useMarkSendInput:
 
 
 
-import os, os.path, copy, types
-import struct
+import os, os.path, types, inspect, weakref
 import time
+from timeit import default_timer as timer
 #from natlink import *
 import natlink
 #from gramparser import *
 import gramparser
+import gramcache
+import gramoptimizer
+import grammatcher
+import natlinktiming
+import natlinktrace
+from gramsymbols import internSymbol, getObjectSize
+
+# compiled grammars are kept in this cache (set to None to switch off):
+grammarCache = gramcache.GrammarCache()
+
+# the GrammarBase instances that are loaded (weak references):
+loadedGrammars = weakref.WeakSet()
+
+# natlink calls saved by the rule activation bookkeeping (all grammars):
+activationStats = dict(nativeCallsAvoided=0)
+
+# hypotheses passed to gotHypothesis and dropped by the coalescing (all
+# grammars, see GramClassBase.hypothesisWindow):
+hypothesisStats = dict(delivered=0, dropped=0)
+
+# actions prepared from hypotheses (all grammars, see GrammarBase.setPrepare):
+# prepared, used at the final results (hits), not available (misses) and
+# prepare functions that failed:
+prepareStats = dict(prepared=0, hits=0, misses=0, failed=0)
 
 # The following constants define the common windows message codes which
 # are passed to playEvents.
@@ -231,8 +274,27 @@ def playString(keys, hooks=None):
 
 class GramClassBase:
 
+    # hypothesis coalescing: when set (seconds), gotHypothesis is called at
+    # most once per window, with the newest hypothesis.  The hypotheses that
+    # arrive within the window are kept in pendingHypothesis (each newer one
+    # replacing the older one).  The first hypothesis after the window is
+    # passed at once (replacing the pending one).  A hypothesis that is
+    # still pending when the results (or the next utterance) come in is
+    # stale and is dropped, so no gotHypothesis work is done at the end of
+    # the utterance.  The hypotheses replaced or dropped are counted in
+    # hypothesesDropped and in hypothesisStats.
+    # Set in a subclass or with setHypothesisWindow, 0 passes every
+    # hypothesis as before.
+    hypothesisWindow = 0
+
     def __init__(self):
         self.gramObj = natlink.GramObj()
+        self.exclusiveState = None  # None: not known
+        self.nativeCallsAvoided = 0
+        self.pendingHypothesis = None
+        self.lastHypothesisTime = None
+        self.hypothesesDelivered = 0
+        self.hypothesesDropped = 0
 
     def __del__(self):
         self.gramObj.unload()
@@ -242,9 +304,12 @@ class GramClassBase:
         self.gramObj.setResultsCallback(self.resultsCallback)
         self.gramObj.setHypothesisCallback(self.hypothesisCallback)
         self.gramObj.load(grammar,allResults,hypothesis)
+        self.exclusiveState = None
 
     def unload(self):        
         self.gramObj.unload()
+        self.exclusiveState = None
+        self.dropPendingHypothesis()
         self.gramObj.setBeginCallback(None)
         self.gramObj.setResultsCallback(None)
         self.gramObj.setHypothesisCallback(None)
@@ -252,22 +317,85 @@ class GramClassBase:
     def activate(self,window=0,exclusive=None):
         self.gramObj.activate('',window)
         if exclusive != None:
-            self.gramObj.setExclusive(exclusive)
+            self.setExclusive(exclusive)
 
     def deactivate(self):
         self.gramObj.deactivate('')
 
+    # the exclusive state is only passed to natlink when it changes:
+
     def setExclusive(self, exclusive):
+        exclusive = exclusive and 1 or 0
+        if exclusive == self.exclusiveState:
+            self.countCallsAvoided(1)
+            return
         self.gramObj.setExclusive(exclusive)
+        self.exclusiveState = exclusive
+
+    def countCallsAvoided(self, n):
+        self.nativeCallsAvoided += n
+        activationStats['nativeCallsAvoided'] += n
         
     def beginCallback(self, moduleInfo):
+        if self.lastHypothesisTime is not None:
+            self.dropPendingHypothesis()
         self.callIfExists( "gotBegin", (moduleInfo,) )
 
     def hypothesisCallback(self, words):
+        if natlinktrace.recorder:
+            natlinktrace.record(natlinktrace.HYPOTHESIS, self.getReportName(), words)
+        window = self.hypothesisWindow
+        if window:
+            now = timer()
+            if self.lastHypothesisTime is not None and \
+                   now - self.lastHypothesisTime < window:
+                if self.pendingHypothesis is not None:
+                    self.countHypotheses(0, 1)
+                self.pendingHypothesis = words
+                return
+            if self.pendingHypothesis is not None:
+                self.pendingHypothesis = None
+                self.countHypotheses(0, 1)
+            self.lastHypothesisTime = now
+        self.countHypotheses(1, 0)
         self.callIfExists( "gotHypothesis", (words,) )
 
+    def setHypothesisWindow(self, seconds):
+        """set the coalescing window of this grammar (0 or None: off)"""
+        self.hypothesisWindow = seconds or 0
+        self.dropPendingHypothesis()
+
+    def flushHypothesis(self):
+        """pass the pending hypothesis (if any) to gotHypothesis now
+
+        for example from a timer callback of the grammar, so the last
+        hypothesis of a window is shown before the next one comes in.
+        """
+        words = self.pendingHypothesis
+        if words is not None:
+            self.pendingHypothesis = None
+            self.lastHypothesisTime = timer()
+            self.countHypotheses(1, 0)
+            self.callIfExists( "gotHypothesis", (words,) )
+
+    # called when the results (or the next utterance) come in, a hypothesis
+    # that is still pending is stale then:
+
+    def dropPendingHypothesis(self):
+        if self.pendingHypothesis is not None:
+            self.countHypotheses(0, 1)
+        self.pendingHypothesis = None
+        self.lastHypothesisTime = None
+
+    def countHypotheses(self, delivered, dropped):
+        self.hypothesesDelivered += delivered
+        self.hypothesesDropped += dropped
+        hypothesisStats['delivered'] += delivered
+        hypothesisStats['dropped'] += dropped
+
     # This is a utility function.  It calls a member function if and only
-    # if that member function is defined.
+    # if that member function is defined.  When the callback timing is on
+    # (natlinktiming), callIfExists is replaced by callIfExistsTimed.
 
     def callIfExists(self, funcName, argList):
         try: func = getattr(self, funcName)
@@ -275,6 +403,118 @@ class GramClassBase:
         else:
             return apply(func, argList)
 
+    callIfExistsPlain = callIfExists
+
+    def callIfExistsTimed(self, funcName, argList):
+        try: func = getattr(self, funcName)
+        except AttributeError: pass
+        else:
+            return natlinktiming.timeCall(self.getReportName(), funcName, func, argList)
+
+    def getReportName(self):
+        """name of the grammar in timing and memory reports and in traces"""
+        return '%s.%s'% (self.__class__.__module__, self.__class__.__name__)
+
+#---------------------------------------------------------------------------
+# RecognitionResult
+#
+# The results of one recognition of a GrammarBase grammar (self.results in
+# the callbacks).  It keeps the wordsAndNums list passed by natlink, the
+# other views are computed on first use:
+#
+#   words           the recognized words
+#   fullResults     list of (word, ruleName)
+#   seqsAndRules    fullResults with the words that are sequential and in the
+#                   same rule together in a sublist.  For example:
+#       [ ('red','color'), ('blue','color'), ('and','conj'), ('green','color') ]
+#                   Becomes:
+#       [ (['red','blue'],'color'), (['and'],'conj'), (['green'],'color') ]
+#   wordsByRule     {ruleName: list of words}
+
+class RecognitionResult(object):
+    __slots__ = ('wordsAndNums', 'ruleNames', '_words', '_fullResults',
+                 '_seqsAndRules', '_wordsByRule')
+
+    def __init__(self, wordsAndNums, ruleNames):
+        self.wordsAndNums = wordsAndNums
+        self.ruleNames = ruleNames  # {ruleNumber: ruleName}
+        self._words = None
+        self._fullResults = None
+        self._seqsAndRules = None
+        self._wordsByRule = None
+
+    def getWords(self):
+        if self._words is None:
+            self._words = [x[0] for x in self.wordsAndNums]
+        return self._words
+    words = property(getWords)
+
+    def getFullResults(self):
+        if self._fullResults is None:
+            ruleNames = self.ruleNames
+            try:
+                self._fullResults = [(x[0], ruleNames[x[1]]) for x in self.wordsAndNums]
+            except KeyError:
+                numbers = [x[1] for x in self.wordsAndNums if x[1] not in ruleNames]
+                print '='*50
+                print 'wordsAndNums: %s'% self.wordsAndNums
+                print 'ruleMap: %s'% `ruleNames`
+                mess =  'Invalid key %s for ruleMap'% numbers[0]
+                raise KeyError(mess)
+        return self._fullResults
+    fullResults = property(getFullResults)
+
+    def getSeqsAndRules(self):
+        if self._seqsAndRules is None:
+            seqsAndRules = []
+            lastRuleName = None
+            for word, ruleName in self.fullResults:
+                if ruleName == lastRuleName:
+                    seqsAndRules[-1][0].append(word)
+                else:
+                    seqsAndRules.append( ([word], ruleName) )
+                    lastRuleName = ruleName
+            self._seqsAndRules = seqsAndRules
+        return self._seqsAndRules
+    seqsAndRules = property(getSeqsAndRules)
+
+    def computeSequences(self):
+        """compute words, fullResults and seqsAndRules in one loop
+
+        returns these three (for resultsCallback)
+        """
+        ruleNames = self.ruleNames
+        words = []
+        fullResults = []
+        seqsAndRules = []
+        lastRuleName = None
+        for word, number in self.wordsAndNums:
+            try:
+                ruleName = ruleNames[number]
+            except KeyError:
+                return self.words, self.fullResults, self.seqsAndRules  # raises error
+            words.append(word)
+            fullResults.append( (word, ruleName) )
+            if ruleName == lastRuleName:
+                seqsAndRules[-1][0].append(word)
+            else:
+                seqsAndRules.append( ([word], ruleName) )
+                lastRuleName = ruleName
+        self._words, self._fullResults, self._seqsAndRules = words, fullResults, seqsAndRules
+        return words, fullResults, seqsAndRules
+
+    def getWordsByRule(self):
+        if self._wordsByRule is None:
+            wordsByRule = {}
+            for word, ruleName in self.fullResults:
+                if ruleName in wordsByRule:
+                    wordsByRule[ruleName].append(word)
+                else:
+                    wordsByRule[ruleName] = [word]
+            self._wordsByRule = wordsByRule
+        return self._wordsByRule
+    wordsByRule = property(getWordsByRule)
+
 #---------------------------------------------------------------------------
 # GrammarBase
 #
@@ -283,7 +523,7 @@ class GramClassBase:
 #
 # Here are the functions which derived classes can call:
 #
-#   load( gramSpec, allResults=0, hypothesis=0 )
+#   load( gramSpec, allResults=0, hypothesis=0, grammarName=None, optimize=None )
 #       This function will takes a textual representation of a grammar,
 #       either as a single string or as a list of strings and load that
 #       grammar into Dragon NaturallySpeaking.
@@ -292,6 +532,8 @@ class GramClassBase:
 #           result even if it is for another grammar,
 #       hypothesis=1 means that the gotHypothesis callback will be made.
 #           Otherwise, that callback is not made to avoid too much overhead.
+#       optimize=1 passes the parsed grammar through gramoptimizer before
+#           packing (default: the class attribute optimizeGrammar, 0).
 #
 #   unload()
 #       Unload reset the state of the grammar.  Any SAPI objects will be
@@ -336,6 +578,14 @@ class GramClassBase:
 #       Set or reset the exclusive flag for this grammar (see comments under
 #       activate method).
 #
+# activeRules is the list of the active rule names and validRules the list
+# of the exported rule names (as before).  For the checks these are kept as
+# sets too, activeRuleSet and validRuleSet; do not change activeRules
+# directly, use the activate functions.  These only call natlink for the
+# rules whose state changes, and setExclusive only when the exclusive state
+# changes.  The number of calls saved this way is counted in the attribute
+# nativeCallsAvoided, and for all grammars together in activationStats.
+#
 # Lists are part of SAPI.  They are list subrules except that they can be
 # changed while the grammar is loaded.  Also, the list a word comes from is
 # not available in recognition results, you only see the innermost rule name
@@ -350,7 +600,12 @@ class GramClassBase:
 #
 #   setList( listName, words )
 #       This function is an efficient way to set the contents of a list in    
-#       one operation to a list of words or phrases.
+#       one operation to a list of words or phrases.  The current contents
+#       are kept in listContents, and only the necessary changes are passed
+#       to natlink: nothing if the words are the same (in the same order,
+#       with the same duplicates), appendList if words were only added at
+#       the end, else the list is emptied and filled again.  listStats gives
+#       for each list the number of natlink calls performed and skipped.
 #
 # Derived classes should defined callback functions if they want recognition
 # results.  The following callback functions can be defined:
@@ -385,6 +640,30 @@ class GramClassBase:
 #   gotHypothesis( words)
 #       only called when the hypothesis flag is set on load, this callback
 #       contains the partial recognition hypothesis during recognition.
+#       With hypothesisWindow set (seconds, in the class or with
+#       setHypothesisWindow), it is called at most once per window with the
+#       newest hypothesis, see GramClassBase.
+#
+# Speculative preparation: a grammar (loaded with hypothesis=1) can do the
+# expensive part of its actions while the user is still speaking:
+#
+#   setPrepare( prepare, maxPrepared=None )
+#       prepare( words, fullResults ) is called for each hypothesis that
+#       matches an active rule of the grammar (matched in python with
+#       grammatcher, the lists as set with setList), with the same parameters
+#       as gotResults.  It must not have side effects (the hypothesis may
+#       not be the final result): it returns an action, for example the
+#       events of senddragonkeys_to_events or the text of nsformat.  The
+#       actions are kept by their words, at most maxPrepared (default 20)
+#       per utterance.
+#       setPrepare(None) switches off.
+#
+#   getPreparedAction()
+#       In the results callbacks: the action prepared for the recognized
+#       words, or, if there was none, the result of prepare(words,
+#       fullResults) now.  The prepared actions of other words are discarded
+#       when the results come in.  The counts are in prepareCounts and, for
+#       all grammars together, prepareStats.
 #       
 # Here is an example of how the callbacks work.  Assume the following grammar:
 #
@@ -420,11 +699,39 @@ class GrammarBase(GramClassBase):
     def __init__(self):
         GramClassBase.__init__(self)
         self.activeRules = []
+        self.activeRuleSet = set()
         self.validRules = []
+        self.validRuleSet = frozenset()
         self.validLists = []
+        self.ruleNames = ()  # rule name for each rule number (index)
+        self.ruleHandlers = {}
+        self.ruleNameByNumber = {}
+        self.resultsHandlers = (None, None, None)
+        self.results = None
+        self.scanSource = None  # (gramSpec, grammarName), see scanObj
+        self.listContents = {}  # listName: words, as passed to natlink
+        self.listStats = {}  # listName: native calls performed and skipped
+        self.optimized = 0
+        self.prepareFunction = None  # see setPrepare
+        self.preparedActions = {}  # words (tuple): action
+        self.preparedAction = None  # (results, action) of the last results
+        self.matcher = None
+        self.matcherVersion = None  # stateVersion the matcher was synced to
+        self.stateVersion = 0  # changed with the active rules and the lists
+        self.prepareCounts = dict(prepared=0, hits=0, misses=0, failed=0)
         self.doOnlyGotResultsObject = None # can rarely be set (QH, dec 2009)
 
-    def load(self,gramSpec,allResults=0,hypothesis=0, grammarName=None):
+    # set to 1 in a subclass to pass all grammars through gramoptimizer:
+    optimizeGrammar = 0
+
+    # the number of actions prepared from hypotheses per utterance (setPrepare):
+    maxPrepared = 20
+
+    def load(self,gramSpec,allResults=0,hypothesis=0, grammarName=None, optimize=None):
+        # while natlinkmain imports a module, the time is recorded for it:
+        loading = natlinktiming.loadingModule
+        if loading:
+            t0 = timer()
         if type(gramSpec) == types.StringType:
             gramSpec = [gramSpec]
         elif type(gramSpec) != types.ListType:
@@ -433,28 +740,83 @@ class GrammarBase(GramClassBase):
             raise TypeError( "grammar definition must be a list of strings" )
 
         gramparser.splitApartLines(gramSpec)
-        parser = gramparser.GramParser(gramSpec, grammarName=grammarName)
-        parser.doParse()
-        parser.checkForErrors()
-        gramBin = gramparser.packGrammar(parser)
-        self.scanObj = parser.scanObj  # for later error messages.
+        # a grammar that was compiled before is taken from the grammarCache,
+        # no scanning, parsing and packing needed then:
+        if optimize is None:
+            optimize = self.optimizeGrammar
+        optimize = optimize and 1 or 0
+        cacheKey = compiled = None
+        if grammarCache:
+            cacheKey = grammarCache.getKey(gramSpec, optimize)
+            compiled = grammarCache.get(cacheKey)
+        if not compiled:
+            parser = gramparser.GramParser(gramSpec, grammarName=grammarName)
+            parser.doParse()
+            parser.checkForErrors()
+            if optimize:
+                gramoptimizer.optimizeGrammar(parser)
+            compiled = dict(gramBin=gramparser.packGrammar(parser),
+                            exportRules=parser.exportRules,
+                            knownLists=parser.knownLists,
+                            knownRules=parser.knownRules,
+                            ruleAliases=parser.ruleAliases)
+            if cacheKey:
+                grammarCache.put(cacheKey, compiled)
+        gramBin = compiled['gramBin']
         try:
             GramClassBase.load(self,gramBin,allResults,hypothesis)
         except natlink.BadGrammar:
             print 'GrammarBase, cannot load grammar, BadGrammar:\n%s\n'% gramSpec
             raise
+        # only the gramSpec (not a copy) is kept for later error messages,
+        # the scanner object is made when needed (see getScanObj)
+        self.scanSource = (gramSpec, grammarName)
+        loadedGrammars.add(self)
+        # the lists of a newly loaded grammar are empty:
+        self.listContents = {}
+        self.optimized = optimize
+        self.matcher = None
+        self.stateVersion += 1
+        self.preparedActions = {}
+
         # we want to keep a list of the rules which can be activated and the
-        # known lists so we can catch errors earlier
-        self.validRules = parser.exportRules.keys()
-        self.validLists = parser.knownLists.keys()
+        # known lists so we can catch errors earlier.  The names are interned
+        # (gramsymbols), so grammars with the same rule names share them.
+        self.validRules = [internSymbol(x) for x in compiled['exportRules'].keys()]
+        self.validRuleSet = frozenset(self.validRules)
+        self.validLists = [internSymbol(x) for x in compiled['knownLists'].keys()]
 
         # we reverse the rule dictionary so we can convert rule numbers back
-        # to rule names during recognition
-        self.ruleMap = {}
-        for x in parser.knownRules.keys():
-            self.ruleMap[ parser.knownRules[x] ] = x
+        # to rule names during recognition (internal rules of gramoptimizer
+        # are reported as the rule they were taken from).  Rule numbers
+        # start at 1, so a tuple indexed by rule number is used.
+        knownRules = compiled['knownRules']
+        ruleAliases = compiled.get('ruleAliases', {})
+        ruleNames = [None] * (max(knownRules.values() or [0]) + 1)
+        for x in knownRules.keys():
+            ruleNames[ knownRules[x] ] = internSymbol(ruleAliases.get(x, x))
+        self.ruleNames = tuple(ruleNames)
+        self.buildDispatch()
+        if loading:
+            natlinktiming.recordLoad(loading, 'grammars', timer() - t0)
         return 1
 
+    def getScanObj(self):
+        """return a scanner object of the grammar text, for error messages
+        """
+        gramSpec, grammarName = self.scanSource or ([''], None)
+        scanObj = gramparser.GramScanner(gramSpec, grammarName=grammarName)
+        scanObj.phase = "after"
+        return scanObj
+
+    scanObj = property(getScanObj)
+
+    def getRuleMap(self):
+        """return the dict {ruleNumber: ruleName} (made from ruleNames)"""
+        return dict([(i, name) for i, name in enumerate(self.ruleNames) if name is not None])
+
+    ruleMap = property(getRuleMap)
+
     # these are wrappers for the GramObj base methods.  We also keep track of
     # legal rules, lists and active rules so we can do some first level error
     # checking
@@ -462,90 +824,241 @@ class GrammarBase(GramClassBase):
     def unload(self):
         GramClassBase.unload(self)
         self.activeRules = []
+        self.activeRuleSet = set()
+        self.listContents = {}
+        self.matcher = None
+        self.stateVersion += 1
+        self.preparedActions = {}
+        self.ruleHandlers = {}
+        self.resultsHandlers = (None, None, None)
+        loadedGrammars.discard(self)
 
     def activate(self, ruleName, window=0, exclusive=None, noError=0):
-        if ruleName not in self.validRules:
+        if ruleName not in self.validRuleSet:
             raise gramparser.GrammarError( "rule %s was not exported in the grammar" % ruleName , self.scanObj)
-        if ruleName in self.activeRules:
+        if ruleName in self.activeRuleSet:
             if noError: return None
             raise gramparser.GrammarError( "rule %s is already active"% ruleName, self.scanObj)
+        loading = natlinktiming.loadingModule
+        if loading:
+            t0 = timer()
         self.gramObj.activate(ruleName,window)
         self.activeRules.append(ruleName)
+        self.activeRuleSet.add(ruleName)
+        self.stateVersion += 1
         if exclusive != None:
-            self.gramObj.setExclusive(exclusive)
+            self.setExclusive(exclusive)
+        if loading:
+            natlinktiming.recordLoad(loading, 'activate', timer() - t0)
 
     def deactivate(self, ruleName, noError=0):
-        if ruleName not in self.validRules:
+        if ruleName not in self.validRuleSet:
             if noError: return
             raise gramparser.GrammarError( "rule %s was not exported in the grammar" % ruleName, self.scanObj)
-        if ruleName not in self.activeRules:
+        if ruleName not in self.activeRuleSet:
             if noError: return
             raise gramparser.GrammarError( "rule %s is not active", self.scanObj)
         self.gramObj.deactivate(ruleName)
         self.activeRules.remove(ruleName)
+        self.activeRuleSet.remove(ruleName)
+        self.stateVersion += 1
 
     def activateSet(self, ruleNames, window=0, exclusive=None):
-        if not type(ruleNames ) in (types.ListType, types.TupleType):
-            raise TypeError("activateSet, ruleNames (%s) must be a list or a tuple, not: %s"%
+        if not type(ruleNames ) in (types.ListType, types.TupleType, set, frozenset):
+            raise TypeError("activateSet, ruleNames (%s) must be a list, tuple or set, not: %s"%
                             (`ruleNames`, type(ruleNames)))
-        for x in copy.copy(self.activeRules):
-            if not x in ruleNames:
+        loading = natlinktiming.loadingModule
+        if loading:
+            t0 = timer()
+        wanted = set(ruleNames)
+        activeRuleSet = self.activeRuleSet
+        if wanted == activeRuleSet:
+            self.countCallsAvoided(len(wanted))
+        else:
+            invalid = wanted - self.validRuleSet
+            if invalid:
+                raise gramparser.GrammarError( "rule %s was not exported in the grammar" % min(invalid), self.scanObj )
+            self.countCallsAvoided(len(wanted & activeRuleSet))
+            # activeRules and activeRuleSet are updated per rule, so they
+            # stay the same when natlink raises an error halfway:
+            for x in activeRuleSet - wanted:
                 self.gramObj.deactivate(x)
                 self.activeRules.remove(x)
-        for x in ruleNames:
-            if x not in self.validRules:
-                raise gramparser.GrammarError( "rule %s was not exported in the grammar" % x, self.scanObj )
-            if not x in self.activeRules:
-                self.gramObj.activate(x,window)
-                self.activeRules.append(x)
+                activeRuleSet.remove(x)
+                self.stateVersion += 1
+            # the order of ruleNames is kept for the rules that are activated:
+            for x in ruleNames:
+                if x not in activeRuleSet:
+                    self.gramObj.activate(x,window)
+                    self.activeRules.append(x)
+                    activeRuleSet.add(x)
+                    self.stateVersion += 1
         if exclusive != None:
-            self.gramObj.setExclusive(exclusive)
+            self.setExclusive(exclusive)
+        if loading:
+            natlinktiming.recordLoad(loading, 'activate', timer() - t0)
 
     def deactivateSet(self, ruleNames, noError=0):
-        if not type(ruleNames ) in (types.ListType, types.TupleType):
-            raise TypeError("deactivateSet, ruleNames (%s) must be a list or a tuple, not: %s"%
+        if not type(ruleNames ) in (types.ListType, types.TupleType, set, frozenset):
+            raise TypeError("deactivateSet, ruleNames (%s) must be a list, tuple or set, not: %s"%
                             (`ruleNames`, type(ruleNames)))
         for x in ruleNames:
             self.deactivate(x, noError=noError)
 
     def activateAll(self, window=0, exclusive=None, exceptlist=None):
-        if exceptlist:
-            for x in exceptlist:
-                if x in self.activeRules:
-                    self.gramObj.deactivate(x)
-                    self.activeRules.remove(x)
+        loading = natlinktiming.loadingModule
+        if loading:
+            t0 = timer()
+        exceptSet = set(exceptlist or [])
+        activeRuleSet = self.activeRuleSet
+        for x in activeRuleSet & exceptSet:
+            self.gramObj.deactivate(x)
+            self.activeRules.remove(x)
+            activeRuleSet.remove(x)
+            self.stateVersion += 1
+        avoided = 0
         for x in self.validRules:
-            if x not in self.activeRules:
-                if exceptlist and x in exceptlist:
-                    continue
-                self.gramObj.activate(x,window)
-                self.activeRules.append(x)
+            if x in exceptSet:
+                continue
+            if x in activeRuleSet:
+                avoided += 1
+                continue
+            self.gramObj.activate(x,window)
+            self.activeRules.append(x)
+            activeRuleSet.add(x)
+            self.stateVersion += 1
+        self.countCallsAvoided(avoided)
         if exclusive != None:
-            self.gramObj.setExclusive(exclusive)
+            self.setExclusive(exclusive)
+        if loading:
+            natlinktiming.recordLoad(loading, 'activate', timer() - t0)
 
     def deactivateAll(self):
-        for x in self.activeRules:
+        for x in list(self.activeRules):
             self.gramObj.deactivate(x)
-        self.activeRules = []
-        self.gramObj.setExclusive(0)
+            self.activeRules.remove(x)
+            self.activeRuleSet.remove(x)
+            self.stateVersion += 1
+        self.setExclusive(0)
 
     def emptyList(self, listName):
         if listName not in self.validLists:
             raise gramparser.GrammarError( "list %s was not defined in the grammar" % listName , self.scanObj)
         self.gramObj.emptyList(listName)
+        self.listContents[listName] = []
+        self.stateVersion += 1
+        self.countListCalls(listName, 1, 0)
 
     def appendList(self, listName, words):
         if listName not in self.validLists:
             raise gramparser.GrammarError( "list %s was not defined in the grammar" % listName , self.scanObj)
-        if type(words) == type(""):
-            self.gramObj.appendList(listName,words)
-        else:
-            for x in words:
-                self.gramObj.appendList(listName,x)
-    
+        if type(words) in (types.StringType, types.UnicodeType):
+            words = [words]
+        contents = self.listContents.setdefault(listName, [])
+        n = 0
+        for x in words:
+            self.gramObj.appendList(listName,x)
+            contents.append(x)
+            n += 1
+        self.stateVersion += 1
+        self.countListCalls(listName, n, 0)
+
+    # setList compares the words with the current contents of the list (as
+    # sequences, so a different order or dropped duplicates are a change):
+    # if they are the same nothing is done, if words were only added at the
+    # end these are appended, else the list is emptied and filled again.
+
     def setList(self, listName, words):
-        self.emptyList(listName)
-        self.appendList(listName, words)
+        if listName not in self.validLists:
+            raise gramparser.GrammarError( "list %s was not defined in the grammar" % listName , self.scanObj)
+        if type(words) in (types.StringType, types.UnicodeType):
+            words = [words]
+        words = list(words)
+        if listName not in self.listContents:
+            self.emptyList(listName)
+            self.appendList(listName, words)
+            return
+        current = self.listContents[listName]
+        n = len(current)
+        if words == current:
+            self.countListCalls(listName, 0, 1 + n)
+        elif len(words) > n and words[:n] == current:
+            self.countListCalls(listName, 0, 1 + n)
+            self.appendList(listName, words[n:])
+        else:
+            self.emptyList(listName)
+            self.appendList(listName, words)
+
+    def countListCalls(self, listName, performed, skipped):
+        stats = self.listStats.setdefault(listName, dict(performed=0, skipped=0))
+        stats['performed'] += performed
+        if skipped:
+            stats['skipped'] += skipped
+            self.countCallsAvoided(skipped)
+
+    def getListSizes(self):
+        """return {listName: number of words} of the lists that were set"""
+        return dict([(name, len(words)) for name, words in self.listContents.items()])
+
+    listSizes = property(getListSizes)
+
+    # The callbacks of resultsCallback are looked up once, in load (see
+    # buildDispatch):
+    #   ruleNameByNumber {ruleNumber: ruleName}, with the numbers 1000000
+    #                   and 1000001 (used for dgndictation and dgnletters by
+    #                   NatSpeak 10) included when these rules are imported
+    #   ruleHandlers    {ruleName: gotResults_ruleName}, only the rules that
+    #                   have a handler
+    #   resultsHandlers the gotResultsObject, gotResultsInit and gotResults
+    #                   methods (or None)
+    # The handlers are the functions of the class (not bound methods, these
+    # would make a reference cycle through the grammar, which is never
+    # collected because of GramClassBase.__del__), they are called with the
+    # grammar as first argument.  A handler that is set on the grammar
+    # itself (not on the class) is looked up by name at each call.  Call
+    # buildDispatch again if handlers are added or removed after load.  When
+    # the callback timing is on (natlinktiming) the handlers are wrapped in
+    # timing functions.
+    #
+    # The results of a recognition are kept in self.results, a
+    # RecognitionResult object, which computes words, fullResults,
+    # seqsAndRules and wordsByRule only when they are needed.  These are
+    # also available as attributes of the grammar (as before).
+
+    def getHandler(self, name):
+        """the function name of the grammar, to be called with the grammar
+        as first argument, or None"""
+        func = getattr(self.__class__, name, None)
+        if name in self.__dict__ or (func is None and hasattr(self, name)):
+            return instanceHandler(name)
+        return getattr(func, 'im_func', func)
+
+    def buildDispatch(self):
+        ruleNameByNumber = {}
+        handlers = {}
+        for number, ruleName in enumerate(self.ruleNames):
+            if ruleName is None:
+                continue
+            ruleNameByNumber[number] = ruleName
+            if ruleName not in handlers:
+                handlers[ruleName] = self.getHandler('gotResults_'+ruleName)
+        for number, ruleName in ((1000000, 'dgndictation'), (1000001, 'dgnletters')):
+            if ruleName in handlers and number not in ruleNameByNumber:
+                ruleNameByNumber[number] = ruleName
+        handlers = dict([(ruleName, handler) for ruleName, handler in handlers.items() if handler])
+        resultsHandlers = [self.getHandler(name) for name in
+                           ('gotResultsObject', 'gotResultsInit', 'gotResults')]
+        if natlinktiming.enabled:
+            reportName = self.getReportName()
+            wrap = natlinktiming.wrapHandler
+            for ruleName, handler in handlers.items():
+                handlers[ruleName] = wrap(reportName, 'gotResults_'+ruleName, handler)
+            for i, name in enumerate(('gotResultsObject', 'gotResultsInit', 'gotResults')):
+                if resultsHandlers[i]:
+                    resultsHandlers[i] = wrap(reportName, name, resultsHandlers[i])
+        self.ruleHandlers = handlers
+        self.ruleNameByNumber = ruleNameByNumber
+        self.resultsHandlers = tuple(resultsHandlers)
 
     # when a recognition for this grammar occurs, this function gets called
     # by GramObj (it is set as the callback in GrammarBase.load.
@@ -554,76 +1067,158 @@ class GrammarBase(GramClassBase):
         # if the allResults flag is set it is possible that the first
         # parameter will be a string instead of a data structure. We 
         # compute the recognition type from this parameter
+        if natlinktrace.recorder:
+            natlinktrace.record(natlinktrace.RESULTS, self.getReportName(), wordsAndNums)
         if type(wordsAndNums) == types.StringType: 
             recogType = wordsAndNums
         else:
             recogType = 'self'
+        if self.lastHypothesisTime is not None:
+            self.dropPendingHypothesis()
+        if self.preparedActions and type(wordsAndNums) != type([]):
+            self.preparedActions = {}
 
         # make an optional callback which allows the clients to have access 
         # to the recognition object
-        self.callIfExists( 'gotResultsObject', (recogType,resObj) )
+        gotResultsObject, gotResultsInit, gotResults = self.resultsHandlers
+        if gotResultsObject:
+            gotResultsObject(self, recogType, resObj)
 
         # do nothing more if the recog results were not for this grammar
         if type(wordsAndNums) != type([]):
             return None
 
-        # we first convert the passed array of word/ruleNumbers into an
-        # array of word/ruleNames and an array of only words
-        words = []
-        fullResults = []
-        wordsByRule = {}
         if self.doOnlyGotResultsObject:
             # can switch on in gotResultsObject, so rest of processing is not done.
             # grammar kaiser_dictation, (voicedictation with exclusive mode catching)
             # QH (dec, 2009)
             #print 'skip rest of resultsCallback'
             return
-        for x in wordsAndNums:
-            words.append( x[0] )
-            # the numbering of some rules appears to be different in NatSpeak10, catch with try:
-            try:
-                ruleName = self.ruleMap[x[1]]
-            except KeyError:
-                if x[1] == 1000000 and 'dgndictation' in self.ruleMap.values():
-                    ruleName = 'dgndictation'
-                elif x[1] == 1000001 and 'dgnletters' in self.ruleMap.values():
-                    ruleName = 'dgnletters'
-                else:
-                    print '='*50
-                    print 'wordsAndNums: %s'% wordsAndNums
-                    print 'ruleMap: %s'% `self.ruleMap`
-                    mess =  'Invalid key %s for ruleMap'% x[1]
-                    raise KeyError(mess)
-
-            fullResults.append( ( x[0], ruleName ) )
-            wordsByRule.setdefault(ruleName, []).append(x[0])
-                
-        # we also compute a list similar to fullResults except that we group
-        # all words which are sequential and in the same rule together in a
-        # sublist. For example:
-        #   [ ('red','color'), ('blue','color'), ('and','conj'), ('green','color') ]
-        # Becomes:
-        #   [ (['red','blue'],'color'), (['and'],'conj'), (['green'],'color') ]
-        seqsAndRules = []
-        for x in fullResults:
-            if len(seqsAndRules) > 0 and seqsAndRules[-1:][0][1] == x[1]:
-                # duplicate rule, append previous entry
-                seqsAndRules[-1:][0][0].append(x[0])
-            else:
-                seqsAndRules.append( ([x[0]], x[1]) )
-        # provide fullResults and seqsAndRules also as instance variables:
-        self.fullResults = fullResults
-        self.seqsAndRules = seqsAndRules
-        self.wordsByRule = wordsByRule
+
+        # the words and rule names are computed by the RecognitionResult
+        # object (wordsByRule only if it is asked for):
+        #   fullResults: list of (word, ruleName)
+        #   seqsAndRules: the same, the words which are sequential and in
+        #       the same rule grouped together (see RecognitionResult)
+        #   wordsByRule: {ruleName: words}
+        results = RecognitionResult(wordsAndNums, self.ruleNameByNumber)
+        self.results = results
+        if self.prepareFunction:
+            self.takePreparedAction(results)
+        words, fullResults, seqsAndRules = results.computeSequences()
+
         # now we make the callbacks (in each case we only call the fucntion 
         # if it exists in the derived class)
         # - we first call gotResultsInit
         # - then we make one callback for each different rule found as we
         #   sequentially scan the results (see seqsAndRules example)
         # - finally we call gotResults
-        self.callIfExists( 'gotResultsInit', (words, fullResults) )
+        if gotResultsInit:
+            gotResultsInit(self, words, fullResults)
         self.callRuleResultsFunctions(seqsAndRules, fullResults)
-        self.callIfExists( 'gotResults', (words, fullResults) )
+        if gotResults:
+            gotResults(self, words, fullResults)
+
+    # the views of the last results, as attributes of the grammar:
+
+    def getFullResults(self):
+        return self.results.fullResults
+    fullResults = property(getFullResults)
+
+    def getSeqsAndRules(self):
+        return self.results.seqsAndRules
+    seqsAndRules = property(getSeqsAndRules)
+
+    def getWordsByRule(self):
+        return self.results.wordsByRule
+    wordsByRule = property(getWordsByRule)
+
+    # speculative preparation of actions from the hypotheses, see the
+    # comments above the class:
+
+    def setPrepare(self, prepare, maxPrepared=None):
+        self.prepareFunction = prepare
+        if maxPrepared:
+            self.maxPrepared = maxPrepared
+        self.preparedActions = {}
+        self.preparedAction = None
+
+    def beginCallback(self, moduleInfo):
+        if self.preparedActions:
+            self.preparedActions = {}
+        GramClassBase.beginCallback(self, moduleInfo)
+
+    def hypothesisCallback(self, words):
+        if self.prepareFunction:
+            self.prepareHypothesis(words)
+        GramClassBase.hypothesisCallback(self, words)
+
+    # the matcher gets the active rules and the lists only when these were
+    # changed (stateVersion is changed by load, unload, the activate and
+    # deactivate functions and the list functions):
+
+    def getMatcher(self):
+        """the GrammarMatcher of the loaded grammar, with its rules and lists
+        """
+        matcher = self.matcher
+        if matcher is None:
+            gramSpec, grammarName = self.scanSource
+            parser = gramparser.GramParser(gramSpec, grammarName=grammarName)
+            parser.doParse()
+            if self.optimized:
+                gramoptimizer.optimizeGrammar(parser)
+            matcher = self.matcher = grammatcher.GrammarMatcher(parser, ())
+            self.matcherVersion = None
+        if self.matcherVersion != self.stateVersion:
+            matcher.activateSet(self.activeRules)
+            for listName, words in self.listContents.items():
+                matcher.setList(listName, words)
+            self.matcherVersion = self.stateVersion
+        return matcher
+
+    def prepareHypothesis(self, words):
+        if len(self.preparedActions) >= self.maxPrepared:
+            return
+        wordsAndNums = self.getMatcher().match(words)
+        if not wordsAndNums:
+            return
+        results = RecognitionResult(wordsAndNums, self.ruleNameByNumber)
+        key = tuple(results.words)
+        if key in self.preparedActions:
+            return
+        try:
+            action = self.prepareFunction(results.words, results.fullResults)
+        except Exception:
+            # the hypothesis may be wrong, the action is prepared again
+            # when it is the final result
+            self.countPrepare('failed')
+            return
+        self.preparedActions[key] = action
+        self.countPrepare('prepared')
+
+    def takePreparedAction(self, results):
+        key = tuple(results.words)
+        if key in self.preparedActions:
+            self.preparedAction = (results, self.preparedActions[key])
+            self.countPrepare('hits')
+        else:
+            self.preparedAction = None
+            self.countPrepare('misses')
+        self.preparedActions = {}
+
+    def getPreparedAction(self):
+        """the action for the current results, prepared from a hypothesis or now
+        """
+        results = self.results
+        if self.preparedAction and self.preparedAction[0] is results:
+            return self.preparedAction[1]
+        action = self.prepareFunction(results.words, results.fullResults)
+        self.preparedAction = (results, action)
+        return action
+
+    def countPrepare(self, name):
+        self.prepareCounts[name] += 1
+        prepareStats[name] += 1
 
     def callRuleResultsFunctions(self, seqsAndRules, fullResults):
         """call the rule functions, can be overloaded (eg in DocstringGrammar)
@@ -631,24 +1226,29 @@ class GrammarBase(GramClassBase):
         Also give self.nextRule (the name) self.nextWords, self.prevRule, self.prevWords
         so the result of the adjacent rules are known
         """
-        ruleName, ruleWords = None, None
-        lenSeqsAndRules = len(seqsAndRules)
-        for i, x in enumerate(seqsAndRules):
-            if i == 0:
-                self.prevRule, self.prevWords = None, []
-            else:
-                Prev = copy.copy(seqsAndRules[i-1])
-                self.prevRule, self.prevWords = Prev[1], Prev[0]
-            
-            if i == lenSeqsAndRules - 1:
+        handlers = self.ruleHandlers
+        last = len(seqsAndRules) - 1
+        prevRule, prevWords = None, []
+        for i, (ruleWords, ruleName) in enumerate(seqsAndRules):
+            self.prevRule, self.prevWords = prevRule, prevWords
+            if i == last:
                 self.nextRule, self.nextWords = None, []
-            else:                
-                Next = copy.copy(seqsAndRules[i+1])
-                self.nextRule, self.nextWords = Next[1], Next[0]
-            
-            ruleName, ruleWords = x[1], copy.copy(x[0])    
-            self.callIfExists( 'gotResults_'+ruleName, (ruleWords, fullResults) )
+            else:
+                self.nextWords, self.nextRule = seqsAndRules[i+1]
+            handler = handlers.get(ruleName)
+            if handler:
+                handler(self, ruleWords[:], fullResults)
+            prevRule, prevWords = ruleName, ruleWords
+
 
+# a handler that is set on the grammar instance, looked up at each call
+# (only the name is kept, so no reference to the grammar is made):
+
+def instanceHandler(name):
+    def callHandler(grammar, *args):
+        return getattr(grammar, name)(*args)
+    callHandler.__name__ = name
+    return callHandler
 
 #---------------------------------------------------------------------------
 # DictGramBase
@@ -731,10 +1331,14 @@ class DictGramBase(GramClassBase):
 
     # This code is very similar to the corresponding code in GrammarBase
     def resultsCallback(self, wordsAndNums, resObj):
+        if natlinktrace.recorder:
+            natlinktrace.record(natlinktrace.RESULTS, self.getReportName(), wordsAndNums)
         if type(wordsAndNums) == type(''): 
             recogType = wordsAndNums
         else:
             recogType = 'self'
+        if self.lastHypothesisTime is not None:
+            self.dropPendingHypothesis()
         self.callIfExists( 'gotResultsObject', (recogType,resObj) )
         if type(wordsAndNums) != type([]):
             return None
@@ -750,7 +1354,7 @@ class DictGramBase(GramClassBase):
     # This makes a raw dictation grammar.  The grammar is in SAPI binary
     # format as defined by Microsoft.
     def makeGrammar(self):
-        return struct.pack("LL", 2, 0)
+        return gramparser.GramPacker( (2, 0) ).getBinary()
 
 #---------------------------------------------------------------------------
 # SelectGramBase
@@ -862,10 +1466,14 @@ class SelectGramBase(GramClassBase):
         
     # This code is very similar to the corresponding code in GrammarBase
     def resultsCallback(self, wordsAndNums, resObj):
+        if natlinktrace.recorder:
+            natlinktrace.record(natlinktrace.RESULTS, self.getReportName(), wordsAndNums)
         if type(wordsAndNums) == type(''): 
             recogType = wordsAndNums
         else:
             recogType = 'self'
+        if self.lastHypothesisTime is not None:
+            self.dropPendingHypothesis()
         self.callIfExists( 'gotResultsObject', (recogType,resObj) )
         if type(wordsAndNums) != type([]):
             return None
@@ -897,19 +1505,19 @@ class SelectGramBase(GramClassBase):
     # command grammars.
     # throughWords is a list of words:
     def makeGrammar(self,selectWords,throughWords):
-        output = struct.pack("LL", 10, 0)
+        packer = gramparser.GramPacker( (10, 0) )
         if selectWords:
             wordDict = {}
             for word in selectWords:
                 wordDict[word] = 0
-            output = output + gramparser.packGrammarChunk(0x1017,wordDict)
+            packer.addChunk(0x1017,wordDict)
         # throughWords maybe more words now:
         if throughWords:
             wordDict = {}
             for word in throughWords:
                 wordDict[word] = 0
-            output = output + gramparser.packGrammarChunk(0x1018,wordDict)
-        return output            
+            packer.addChunk(0x1018,wordDict)
+        return packer.getBinary()
         
 #---------------------------------------------------------------------------        
 
@@ -918,6 +1526,19 @@ class SelectGramBase(GramClassBase):
 def getBaseName(name):
     return os.path.splitext(os.path.split(name)[1])[0]
 
+# This routine switches the timing of the grammar callbacks on or off, it is
+# called by natlinktiming.enable and natlinktiming.disable.
+
+def setCallbackTiming(enabled):
+    if enabled:
+        GramClassBase.callIfExists = GramClassBase.__dict__['callIfExistsTimed']
+    else:
+        GramClassBase.callIfExists = GramClassBase.__dict__['callIfExistsPlain']
+    for grammar in list(loadedGrammars):
+        grammar.buildDispatch()
+
+natlinktiming.switchCallbacks.append(setCallbackTiming)
+
 # This utility routine converts a fullResults parameter into a dictionary
 #   [ ('red','color'), ('flower','object'), ('and','conj'), ('green','color') ]
 # Becomes:
@@ -930,3 +1551,20 @@ def convertResults(fullResults):
         else: dict[x[1]] = [x[0]]
     return dict
 
+# This routine reports the memory held by each loaded grammar object
+# (attributes of the instance, not of its class).
+
+def getMemoryReport():
+    report = []
+    for grammar in list(loadedGrammars):
+        seen = set()
+        for cls in inspect.getmro(grammar.__class__):
+            seen.update([id(v) for v in vars(cls).values()])
+        name = grammar.getReportName()
+        grammarName = grammar.scanSource and grammar.scanSource[1]
+        if grammarName:
+            name = '%s (%s)'% (name, grammarName)
+        report.append( (getObjectSize(grammar, seen), name) )
+    report.sort(reverse=True)
+    return report
+
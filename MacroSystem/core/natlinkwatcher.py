@@ -0,0 +1,149 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# natlinkwatcher.py
+#   This module watches the grammar directories for changed python files in
+#   a background thread, so natlinkmain.beginCallback does not have to check
+#   the date of every loaded module before each utterance (when
+#   checkForGrammarChanges is on).  The changed files are collected in a
+#   set, beginCallback only reloads these.
+#
+#   watcher = FileWatcher(directories, interval=1.0, backend=None)
+#   watcher.start()
+#
+#   watcher.dirty
+#       The set of the paths of the python files that were changed, added or
+#       removed since the last takeChanges (test for changes with
+#       "if watcher.dirty").
+#
+#   watcher.takeChanges()
+#       Returns the dirty set and empties it.
+#
+#   watcher.isCurrent()
+#       True if the thread is running and has checked the directories
+#       recently (within staleAfter intervals).  If not (eg when the thread
+#       does not get the chance to run), natlinkmain checks the files itself.
+#
+#   watcher.stop()
+#       Stop the thread.
+#
+# The checking is done by a backend.  PollingBackend (the default) lists the
+# directories every interval seconds and compares the modification times
+# and sizes of the python files with the previous ones.  Another backend
+# (eg one on ReadDirectoryChangesW or inotify) can be passed to the watcher:
+# it overrides run(watcher), which must call watcher.markChanged(path) for
+# each changed file and watcher.markScanned() when it is up to date, until
+# watcher.stopping is set.
+#
+# Paths are compared with normPath (absolute, normalized case).
+#
+import os, os.path, threading, time
+
+def normPath(path):
+    return os.path.normcase(os.path.abspath(path))
+
+class PollingBackend(object):
+    """checks the directories every interval seconds"""
+    extensions = ('.py',)
+
+    def scan(self, directories):
+        """return {path: (mtime, size)} of the python files in directories"""
+        stamps = {}
+        for directory in directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if os.path.splitext(name)[1].lower() not in self.extensions:
+                    continue
+                path = normPath(os.path.join(directory, name))
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stamps[path] = (st.st_mtime, st.st_size)
+        return stamps
+
+    def run(self, watcher):
+        previous = self.scan(watcher.directories)
+        watcher.markScanned()
+        while not watcher.stopping.wait(watcher.interval) and not watcher.stopping.isSet():
+            current = self.scan(watcher.directories)
+            for path, stamp in current.items():
+                if previous.get(path) != stamp:
+                    watcher.markChanged(path)
+            for path in previous:
+                if path not in current:
+                    watcher.markChanged(path)
+            previous = current
+            watcher.markScanned()
+
+class FileWatcher(object):
+    """collects the changed python files of directories in a background thread
+    """
+    # the watcher is not current when it did not check the files within
+    # this number of intervals:
+    staleAfter = 5
+
+    def __init__(self, directories, interval=1.0, backend=None):
+        self.directories = [d for d in directories if d]
+        self.interval = interval
+        self.backend = backend or PollingBackend()
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.lastScan = None
+        self.scans = self.changes = 0
+
+    def start(self):
+        if self.thread and self.thread.isAlive():
+            return
+        self.stopping.clear()
+        self.lastScan = None
+        self.thread = threading.Thread(target=self.run, name='natlinkwatcher')
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.backend.run(self)
+        finally:
+            self.lastScan = None
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread and self.thread is not threading.currentThread():
+            self.thread.join(self.interval + 1)
+        self.thread = None
+
+    def markChanged(self, path):
+        self.lock.acquire()
+        try:
+            self.dirty.add(normPath(path))
+            self.changes += 1
+        finally:
+            self.lock.release()
+
+    def markScanned(self):
+        self.lastScan = time.time()
+        self.scans += 1
+
+    def takeChanges(self):
+        self.lock.acquire()
+        try:
+            dirty, self.dirty = self.dirty, set()
+        finally:
+            self.lock.release()
+        return dirty
+
+    def isCurrent(self):
+        lastScan = self.lastScan
+        return lastScan is not None and \
+               time.time() - lastScan < self.staleAfter * self.interval and \
+               self.thread is not None and self.thread.isAlive()
+
+    def getStats(self):
+        return dict(scans=self.scans, changes=self.changes, dirty=len(self.dirty),
+                    current=self.isCurrent() and 1 or 0)
@@ -0,0 +1,80 @@
+#
+# Python Macro Language for Dragon NaturallySpeaking
+#
+# unittestHypothesis.py
+#   Tests of the hypothesis coalescing of the grammars (hypothesisWindow,
+#   see GramClassBase in natlinkutils.py).  These run without Dragon, with
+#   the stand-in natlink module of natlinktrace:
+#
+#   python unittestHypothesis.py
+#
+import sys, os, os.path, unittest
+
+coreDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'MacroSystem', 'core')
+sys.path.insert(0, os.path.normpath(coreDirectory))
+
+import natlinktrace
+natlinktrace.installStandIn()
+import natlinkutils
+
+class TestGrammar(natlinkutils.GrammarBase):
+    gramSpec = '<start> exported = hello world;'
+    hypothesisWindow = 0.1
+
+    def gotHypothesis(self, words):
+        self.calls.append(('hypothesis', words))
+
+    def gotResults(self, words, fullResults):
+        self.calls.append(('results', words))
+
+class HypothesisWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        # a clock under control of the test:
+        self.clock = 0.0
+        self.savedTimer = natlinkutils.timer
+        natlinkutils.timer = lambda: self.clock
+        self.grammar = TestGrammar()
+        self.grammar.calls = []
+        self.grammar.load(self.grammar.gramSpec, hypothesis=1)
+        self.grammar.activateAll()
+
+    def tearDown(self):
+        self.grammar.unload()
+        natlinkutils.timer = self.savedTimer
+
+    def hypotheses(self, timesAndWords):
+        for t, words in timesAndWords:
+            self.clock = t
+            self.grammar.hypothesisCallback(words)
+
+    def testBurstPendingDroppedAtResults(self):
+        """the first hypothesis of a burst is passed, the pending one is dropped at the results"""
+        self.hypotheses([(0.0, ['hello']), (0.03, ['hello', 'w']), (0.06, ['hello', 'world'])])
+        dropped = natlinkutils.hypothesisStats['dropped']
+        self.clock = 0.08
+        self.grammar.resultsCallback([('hello', 1), ('world', 1)], None)
+        self.assertEqual([('hypothesis', ['hello']), ('results', ['hello', 'world'])],
+                         self.grammar.calls)
+        self.assertEqual(dropped + 1, natlinkutils.hypothesisStats['dropped'])
+        self.assertEqual(None, self.grammar.pendingHypothesis)
+        self.assertEqual(2, self.grammar.hypothesesDropped)
+
+    def testAfterWindow(self):
+        """a hypothesis after the window is passed at once, replacing the pending one"""
+        self.hypotheses([(1.0, ['a']), (1.05, ['a', 'b']), (1.2, ['a', 'b', 'c'])])
+        self.assertEqual([('hypothesis', ['a']), ('hypothesis', ['a', 'b', 'c'])],
+                         self.grammar.calls)
+        self.assertEqual(2, self.grammar.hypothesesDelivered)
+        self.assertEqual(1, self.grammar.hypothesesDropped)
+
+    def testNoWindow(self):
+        """without window every hypothesis is passed"""
+        self.grammar.setHypothesisWindow(0)
+        self.hypotheses([(0.0, ['a']), (0.01, ['a', 'b'])])
+        self.assertEqual([('hypothesis', ['a']), ('hypothesis', ['a', 'b'])],
+                         self.grammar.calls)
+
+if __name__ == "__main__":
+    unittest.main()